@@ -1,9 +1,132 @@
 import six
 import math
+import logging
+import os
 import json
+import mmap
+import struct
 import hashlib
 import random
-from .utils import to_bytes
+import time
+from .utils import to_bytes, to_str
+
+
+logger = logging.getLogger(__name__)
+
+# hash算法版本: 1 每4个hash值计算一次md5; 2 一次md5两个hash值的双重散列(Kirsch-Mitzenmacher)
+# 旧的过滤器没有 hash_version 字段，按版本1处理
+HASH_VERSION_LEGACY = 1
+HASH_VERSION = 2
+
+
+# 扩容模式: 成员数量达到容量后追加一代新的过滤器，容量乘以 GROWTH_SCALE，误判率乘以 TIGHTENING_RATIO
+# 各代误判率之和不超过 probability，第0代按 probability * (1 - TIGHTENING_RATIO) 计算
+GROWTH_SCALE = 2
+TIGHTENING_RATIO = 0.5
+
+
+# 一次调用检查所有代，添加时只写入最新一代；位按全局编号传入，由脚本换算成块及块内偏移
+# 检查的代可以包含其他过滤器(rotating_bloomfilter之前的时间片)的代，排在前面，只读
+# KEYS: 元数据key, 各代所有块的key...
+# ARGV: 块大小, 成员数, 总代数, 是否添加(1/0), 元数据key的代数, 每代的(hash函数数量, 块数)..., 每个成员依次为每代的位...
+# 返回: 成员数量, 代数, 每个成员原来是否已存在...; 代数与调用方不一致时不做处理，只返回成员数量及代数
+# 元数据key已过期时返回 {0, -1}，不写入(否则HINCRBY/SETBIT会重建没有过期时间的key)
+BLOOMFILTER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {0, -1}
+end
+local block_size = tonumber(ARGV[1])
+local n = tonumber(ARGV[2])
+local ngen = tonumber(ARGV[3])
+local add = ARGV[4] == '1'
+local generations = tonumber(redis.call('HGET', KEYS[1], 'generations') or '1')
+if generations ~= tonumber(ARGV[5]) then
+    return {tonumber(redis.call('HGET', KEYS[1], 'elements_size') or '0'), generations}
+end
+local ks, bases = {}, {}
+local base = 1
+local pos = 6
+for g = 1, ngen do
+    ks[g] = tonumber(ARGV[pos])
+    bases[g] = base
+    base = base + tonumber(ARGV[pos + 1])
+    pos = pos + 2
+end
+local result = {0, 0}
+local added = 0
+for i = 1, n do
+    local present = 0
+    for g = 1, ngen do
+        local last = g == ngen
+        if present == 0 then
+            local all = 1
+            for j = pos, pos + ks[g] - 1 do
+                local bit = tonumber(ARGV[j])
+                local block = math.floor(bit / block_size)
+                local key = KEYS[bases[g] + block + 1]
+                local offset = bit - block * block_size
+                local val
+                if add and last then
+                    val = redis.call('SETBIT', key, offset, 1)
+                else
+                    val = redis.call('GETBIT', key, offset)
+                end
+                if val == 0 then
+                    all = 0
+                    if not (add and last) then
+                        break
+                    end
+                end
+            end
+            if all == 1 then
+                present = 1
+            elseif add and last then
+                added = added + 1
+            end
+        end
+        pos = pos + ks[g]
+    end
+    result[#result + 1] = present
+end
+if added > 0 then
+    result[1] = redis.call('HINCRBY', KEYS[1], 'elements_size', added)
+else
+    result[1] = tonumber(redis.call('HGET', KEYS[1], 'elements_size') or '0')
+end
+result[2] = generations
+return result
+"""
+
+# 快照文件: SNAPSHOT_MAGIC, 版本(1字节), json长度(4字节), json, 各块的数据
+# json: {'key': 元数据key, 'meta': 元数据, 'blocks': [[块key, 字节数], ...]}
+SNAPSHOT_MAGIC = b'BFSNAP'
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('>6sBI')
+SNAPSHOT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+# 追加第ARGV[1]代，已有则放弃，元数据key已过期时返回-1；KEYS: 元数据key; ARGV: 代编号, 该代的json
+GROW_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HSETNX', KEYS[1], 'generation_' .. ARGV[1], ARGV[2]) == 1 then
+    redis.call('HSET', KEYS[1], 'generations', tonumber(ARGV[1]) + 1)
+    return 1
+end
+return 0
+"""
+
+# 新建过滤器的元数据，已存在(其他worker已重建)时返回0
+# KEYS: 元数据key ; ARGV: 过期时间, field1, value1, field2, value2...
+CREATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HMSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
 
 
 class bloomfilter(object):
@@ -19,22 +142,46 @@ class bloomfilter(object):
     _elements_max_size = 0     # n
     _elements_size = 0
     _expire_time = 3600
+    _hash_version = HASH_VERSION_LEGACY
+    _scalable = False
 
-    def __init__(self, r, task_id, num_elements=10000, probability=0.001, ttl=3600):
+    def __init__(self, r, task_id, num_elements=10000, probability=0.001, ttl=3600, scalable=False):
+        '''
+        scalable: 成员数量超过 num_elements 后自动扩容，只对新建的过滤器有效
+        '''
         self._key = "key:" + task_id
         self._expire_time = ttl
-        if r.exists(self._key):
-            self.__load_boolfilter(r)
-        else:
-            self.__init_boolfilter(r, num_elements, probability)
+        # 已注册的脚本
+        self._scripts = {}
+        # 各代过滤器，第0代即原有的过滤器
+        self._generations = []
+        self._overfilled = False
+        # 只读快照(open_snapshot)的mmap及块在文件中的位置: 块key -> (偏移, 字节数)
+        self._snapshot = None
+        self._snapshot_blocks = {}
+        # 过期后重建时使用
+        self._params = (num_elements, probability, scalable)
+        self.__open(r)
+
+    def __open(self, r):
+        '''
+        加载已有的过滤器，不存在(或已过期)时新建
+        '''
+        while not (r.exists(self._key) and self.__load_boolfilter(r)):
+            if self.__init_boolfilter(r, *self._params):
+                return
 
-    def __load_boolfilter(self, r):
+    def __load_boolfilter(self, r, hmget=None):
         '''
         elements_max_size: 成员最大数量
         hash_func_num:     hash函数数量
         bloomfilter_size:  bloomfilter过滤器大小
 
         elements_size：    当前成员数量
+        hash_version：     hash算法版本，没有为版本1
+        scalable：         是否自动扩容，没有为否
+        generations：      代数，没有为1
+        generation_N：     第N代(N>=1)的json: bloomfilter_size, elements_max_size, hash_func_num, probability, blocks
         blocks：           存储在redis的块，由于redis最大只能存储512M，在本bloomfilter买块按照256M计算
         ------------------------------------------------------------------------------------------
         blocks 数据格式：
@@ -46,52 +193,152 @@ class bloomfilter(object):
             }
         }
         '''
-        vals = r.hmget(self._key, 'bloomfilter_size', 'elements_max_size', 'hash_func_num', 'elements_size', 'blocks')
+        if hmget is None:
+            hmget = lambda *fields: r.hmget(self._key, *fields)
+        vals = hmget('bloomfilter_size', 'elements_max_size', 'hash_func_num', 'elements_size', 'blocks',
+                     'hash_version', 'scalable', 'generations')
+        if vals[0] is None or vals[4] is None:
+            # 元数据已过期或不完整
+            return False
 
         self._bloomfilter_size = int(vals[0])
         self._elements_max_size = int(vals[1])
         self._hash_func_num = int(vals[2])
         self._elements_size = int(vals[3])
         self._block_dict = json.loads(vals[4])
+        self._hash_version = int(vals[5]) if vals[5] is not None else HASH_VERSION_LEGACY
+        self._scalable = vals[6] is not None and int(vals[6]) == 1
+        generations = int(vals[7]) if vals[7] is not None else 1
+
+        self._generations = [self.__generation(self._bloomfilter_size, self._elements_max_size, self._hash_func_num,
+                                               self._hash_version, self._block_dict)]
+        if generations > 1:
+            fields = ['generation_%d' % i for i in range(1, generations)]
+            for val in hmget(*fields):
+                if val is None:
+                    break
+                info = json.loads(val)
+                self._generations.append(self.__generation(info['bloomfilter_size'], info['elements_max_size'],
+                                                           info['hash_func_num'], HASH_VERSION, info['blocks'],
+                                                           info['probability']))
+        return True
 
-    def __init_boolfilter(self, r, num_elements, probability):
-        self._elements_max_size = num_elements
-        self._elements_size = 0
+    @staticmethod
+    def __generation(bloomfilter_size, elements_max_size, hash_func_num, hash_version, block_dict, probability=None):
+        if probability is None:
+            # p = exp(-m/n * ln2**2)
+            probability = math.exp(-float(bloomfilter_size) / elements_max_size * math.log(2) ** 2)
+        return {
+            'bloomfilter_size': bloomfilter_size,
+            'elements_max_size': elements_max_size,
+            'hash_func_num': hash_func_num,
+            'hash_version': hash_version,
+            'probability': probability,
+            # 块的key，按块编号排列
+            'keys': [block_dict["%d" % i]['key'] for i in range(block_dict['blocknum'])],
+            'block_dict': block_dict,
+        }
 
+    @staticmethod
+    def __sizes(num_elements, probability):
         # k = ln(1/P)/ln2
-        self._hash_func_num = int(math.ceil(math.log(1/probability) / math.log(2)))
-
+        hash_func_num = int(math.ceil(math.log(1/probability) / math.log(2)))
         # m = ln(1/p)/(ln2**2) * n
-        self._bloomfilter_size = int(math.ceil(math.log(1/probability) * num_elements / (math.log(2)**2)))
-        blocknum = int(math.ceil(self._bloomfilter_size / bloomfilter.__REDIS_BLOCK_MAX_SIZE))
+        bloomfilter_size = int(math.ceil(math.log(1/probability) * num_elements / (math.log(2)**2)))
+        return bloomfilter_size, hash_func_num
+
+    def __create_blocks(self, r, prefix, bloomfilter_size, ttl):
+        '''
+        块key带随机后缀，重建或扩容时不会复用元数据过期后残留的旧块(旧块随其ttl删除)
+        '''
+        prefix = "%s_%012x" % (prefix, random.getrandbits(48))
+        blocknum = int(math.ceil(bloomfilter_size / bloomfilter.__REDIS_BLOCK_MAX_SIZE))
 
-        self._block_dict = {
+        block_dict = {
             'blocknum': blocknum,
         }
         for i in range(blocknum):
-            key = "%s_block%d" % (self._key, i)
+            key = "%s_block%d" % (prefix, i)
             block_size = bloomfilter.__REDIS_BLOCK_MAX_SIZE
-            time = self._expire_time + random.randint(30, 100)
+            time = ttl + random.randint(30, 100)
             index = "%d" % i
             if i == (blocknum - 1):
-                block_size = self._bloomfilter_size - i * bloomfilter.__REDIS_BLOCK_MAX_SIZE
-            self._block_dict[index] = {
+                block_size = bloomfilter_size - i * bloomfilter.__REDIS_BLOCK_MAX_SIZE
+            block_dict[index] = {
                 'key': key,
                 'block_size': block_size
             }
             r.setbit(key, block_size-1, 0)
             r.expire(key, time)
+        return block_dict
+
+    @staticmethod
+    def __delete_blocks(r, block_dict):
+        r.delete(*[block_dict["%d" % i]['key'] for i in range(block_dict['blocknum'])])
+
+    def __init_boolfilter(self, r, num_elements, probability, scalable):
+        '''
+        新建过滤器，返回False表示其他worker已先建好(本次建的块已删除)
+        '''
+        self._elements_max_size = num_elements
+        self._elements_size = 0
+        self._scalable = scalable
+        if scalable:
+            probability = probability * (1 - TIGHTENING_RATIO)
+
+        self._bloomfilter_size, self._hash_func_num = self.__sizes(num_elements, probability)
+        self._block_dict = self.__create_blocks(r, self._key, self._bloomfilter_size, self._expire_time)
+
+        self._hash_version = HASH_VERSION
+        self._generations = [self.__generation(self._bloomfilter_size, self._elements_max_size, self._hash_func_num,
+                                               self._hash_version, self._block_dict, probability)]
 
         data = {
             'bloomfilter_size': self._bloomfilter_size,
             'elements_max_size': self._elements_max_size,
             'hash_func_num': self._hash_func_num,
             'elements_size': self._elements_size,
+            'hash_version': self._hash_version,
+            'scalable': 1 if scalable else 0,
+            'generations': 1,
             'blocks': json.dumps(self._block_dict, ensure_ascii=False)
         }
-        r.hmset(self._key, data)
         time = self._expire_time + random.randint(0, 30)
-        r.expire(self._key, time)
+        args = [time]
+        for field, value in data.items():
+            args.extend([field, value])
+        if not self.__script(r, CREATE_SCRIPT)(keys=[self._key], args=args, client=r):
+            self.__delete_blocks(r, self._block_dict)
+            return False
+        return True
+
+    def __grow(self, r):
+        '''
+        追加一代过滤器，多个worker同时扩容时只有一个生效
+        '''
+        last = self._generations[-1]
+        index = len(self._generations)
+        num_elements = last['elements_max_size'] * GROWTH_SCALE
+        probability = last['probability'] * TIGHTENING_RATIO
+        bloomfilter_size, hash_func_num = self.__sizes(num_elements, probability)
+        # 新的块和元数据同时过期
+        ttl = r.ttl(self._key)
+        if ttl is None or ttl < 0:
+            ttl = self._expire_time
+        block_dict = self.__create_blocks(r, "%s_g%d" % (self._key, index), bloomfilter_size, ttl)
+        info = {
+            'bloomfilter_size': bloomfilter_size,
+            'elements_max_size': num_elements,
+            'hash_func_num': hash_func_num,
+            'probability': probability,
+            'blocks': block_dict,
+        }
+        grown = self.__script(r, GROW_SCRIPT)(keys=[self._key], args=[index, json.dumps(info)], client=r)
+        if grown != 1:
+            # 过期或其他worker已扩容，本次建的块没有被使用
+            self.__delete_blocks(r, block_dict)
+        if grown == -1 or not self.__load_boolfilter(r):
+            self.__open(r)
 
     def __create_hashs(self, str1):
         result = [0] * self._hash_func_num
@@ -112,59 +359,291 @@ class bloomfilter(object):
                     k = k + 1
         return result
 
-    def __set_bit(self, r, hashval):
-        val_bit = hashval % self._bloomfilter_size
-        for i in range(self._block_dict['blocknum']):
-            #print("i:", i, "|blocknum:", self._block_dict['blocknum'])
-            index = "%d" % i
-            block_info = self._block_dict[index]
-            if val_bit < block_info['block_size']:
-                r.setbit(block_info['key'], val_bit, 1)
-                break
-            else:
-                val_bit = val_bit - block_info['block_size']
-
-    def __get_bit(self, r, hashval):
-        val_bit = hashval % self._bloomfilter_size
-        val = 0
-        for i in range(self._block_dict['blocknum']):
-            index = "%d" % i
-            block_info = self._block_dict[index]
-            if val_bit < block_info['block_size']:
-                val = r.getbit(block_info['key'], val_bit)
+    @staticmethod
+    def __double_hash(data):
+        '''
+        返回 (h1, h2)，两个64位的hash值来自同一次md5
+        '''
+        digest = hashlib.md5(to_bytes(data)).digest()
+        return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+    def __bits(self, datas, generation):
+        m = generation['bloomfilter_size']
+        k = generation['hash_func_num']
+        if generation['hash_version'] == HASH_VERSION_LEGACY:
+            bits = []
+            for data in datas:
+                bits.extend(hashval % m for hashval in self.__create_hashs(data))
+            return bits
+        # g_i = (h1 + i * h2) mod m，先对m取模避免溢出
+        bits = []
+        for h1, h2 in datas:
+            h1 %= m
+            h2 %= m
+            bits.extend((h1 + i * h2) % m for i in range(k))
+        return bits
+
+    def __script(self, r, script):
+        obj = self._scripts.get(script)
+        if obj is None:
+            obj = self._scripts[script] = r.register_script(script)
+        return obj
+
+    def __capacity(self):
+        return sum(gen['elements_max_size'] for gen in self._generations)
+
+    def __call(self, r, datas, add, previous):
+        '''
+        执行 BLOOMFILTER_SCRIPT，一次往返检查所有代；其他worker扩容后重新加载再执行
+        '''
+        while True:
+            vals = self.__execute(r, datas, add, previous)
+            self._elements_size = int(vals[0])
+            if int(vals[1]) == len(self._generations):
                 break
-            else:
-                val_bit = val_bit - block_info['block_size']
-        return val
+            if int(vals[1]) == -1 or not self.__load_boolfilter(r):
+                # 其他worker创建的过滤器已过期，重建后再执行
+                self.__open(r)
+        if add and self._elements_size >= self.__capacity():
+            if self._scalable:
+                self.__grow(r)
+            elif not self._overfilled:
+                self._overfilled = True
+                logger.warning("bloomfilter %s is over capacity (%d >= %d), false positive rate will rise",
+                               self._key, self._elements_size, self.__capacity())
+        return [bool(val) for val in vals[2:]]
+
+    def __execute(self, r, datas, add, previous):
+        generations = [gen for bf in previous for gen in bf._generations] + self._generations
+        keys = [self._key]
+        args = [bloomfilter.__REDIS_BLOCK_MAX_SIZE, len(datas), len(generations), 1 if add else 0,
+                len(self._generations)]
+        pairs = list(map(self.__double_hash, datas))
+        per_gen = []
+        for gen in generations:
+            keys.extend(gen['keys'])
+            args.extend([gen['hash_func_num'], len(gen['keys'])])
+            gen_hashes = datas if gen['hash_version'] == HASH_VERSION_LEGACY else pairs
+            per_gen.append((gen['hash_func_num'], self.__bits(gen_hashes, gen)))
+        for i in range(len(datas)):
+            for k, bits in per_gen:
+                args.extend(bits[i * k:(i + 1) * k])
+        return self.__script(r, BLOOMFILTER_SCRIPT)(keys=keys, args=args, client=r)
 
     def add(self, r, data):
-        hashes = self.__create_hashs(data)
-        for hashval in hashes:
-            self.__set_bit(r, hashval)
+        '''
+        data 为列表时批量添加并返回列表
+        '''
+        if isinstance(data, (list, tuple)):
+            return self.add_many(r, data)
+        return self.add_many(r, [data])[0]
 
     def contains(self, r, data):
-        hashes = self.__create_hashs(data)
-        for hashval in hashes:
-            if self.__get_bit(r, hashval) == 0:
-                return False
-        return True
-
-    def clear(self, r):
-        for i in range(self._block_dict['blocknum']):
-            index = "%d" % i
-            block_info = self._block_dict[index]
-            r.delete(block_info['key'])
-        r.delete(self._key)
-
+        if isinstance(data, (list, tuple)):
+            return self.contains_many(r, data)
+        return self.contains_many(r, [data])[0]
 
+    def add_many(self, r, datas, previous=()):
+        '''
+        批量添加，一次往返；返回每个成员添加前是否已存在
+        previous: 同时检查(不写入)的其他bloomfilter，在其中已存在的成员不再添加
+        '''
+        if self._snapshot is not None:
+            raise TypeError("bloomfilter snapshot %s is read-only" % self._key)
+        if not datas:
+            return []
+        if not self._scalable:
+            return self.__call(r, datas, True, previous)
+        # 按最新一代剩余容量分批，避免一批成员超出容量
+        result = []
+        while datas:
+            count = max(self.__capacity() - self._elements_size, 1)
+            result.extend(self.__call(r, datas[:count], True, previous))
+            datas = datas[count:]
+        return result
 
+    def contains_many(self, r, datas, previous=()):
+        '''
+        批量判断，一次往返
+        '''
+        if not datas:
+            return []
+        if self._snapshot is not None:
+            return self.__snapshot_contains(datas)
+        return self.__call(r, datas, False, previous)
 
+    def dump(self, r, path, chunk_size=SNAPSHOT_CHUNK_SIZE):
+        '''
+        把元数据及所有块保存到本地文件，块按 chunk_size 分段 GETRANGE 读取
+        不是原子快照，保存期间写入的成员可能只保存了部分位
+        '''
+        meta = dict((to_str(k), to_str(v)) for k, v in r.hgetall(self._key).items())
+        keys = [key for gen in self._generations for key in gen['keys']]
+        lengths = [r.strlen(key) for key in keys]
+        header = json.dumps({
+            'key': self._key,
+            'meta': meta,
+            'blocks': [[key, length] for key, length in zip(keys, lengths)],
+        }).encode('utf-8')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+            f.write(header)
+            for key, length in zip(keys, lengths):
+                start = 0
+                while start < length:
+                    end = min(start + chunk_size, length)
+                    data = r.getrange(key, start, end - 1)
+                    # 保存期间块被删除或缩短时补0，保持长度一致
+                    f.write(data.ljust(end - start, b'\0'))
+                    start = end
+        os.rename(tmp, path)
+
+    @staticmethod
+    def __read_snapshot_header(f):
+        magic, version, length = _SNAPSHOT_HEADER.unpack(f.read(_SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a bloomfilter snapshot")
+        if version > SNAPSHOT_VERSION:
+            raise ValueError("Unsupported bloomfilter snapshot version: %d" % version)
+        return json.loads(f.read(length).decode('utf-8')), _SNAPSHOT_HEADER.size + length
+
+    @classmethod
+    def restore(cls, r, path, ttl=3600, chunk_size=SNAPSHOT_CHUNK_SIZE):
+        '''
+        从 dump 的文件恢复到redis(覆盖同名的key)，返回加载后的bloomfilter
+        '''
+        with open(path, 'rb') as f:
+            info, _ = cls.__read_snapshot_header(f)
+            key = info['key']
+            for block_key, length in info['blocks']:
+                r.delete(block_key)
+                start = 0
+                while start < length:
+                    data = f.read(min(chunk_size, length - start))
+                    r.setrange(block_key, start, data)
+                    start += len(data)
+                r.expire(block_key, ttl + random.randint(30, 100))
+        r.delete(key)
+        r.hmset(key, info['meta'])
+        r.expire(key, ttl + random.randint(0, 30))
+        return cls(r, key[len("key:"):], ttl=ttl)
+
+    @classmethod
+    def open_snapshot(cls, path):
+        '''
+        只读方式通过mmap打开 dump 的文件，contains/contains_many 不访问redis(r 可以为None)
+        '''
+        obj = cls.__new__(cls)
+        obj._scripts = {}
+        obj._overfilled = False
+        with open(path, 'rb') as f:
+            info, offset = cls.__read_snapshot_header(f)
+            obj._snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        obj._key = info['key']
+        obj._snapshot_blocks = {}
+        for block_key, length in info['blocks']:
+            obj._snapshot_blocks[block_key] = (offset, length)
+            offset += length
+        meta = info['meta']
+        obj.__load_boolfilter(None, hmget=lambda *fields: [meta.get(field) for field in fields])
+        return obj
+
+    def __snapshot_contains(self, datas):
+        # redis位图中偏移o在第 o//8 字节的第 7 - o%8 位(高位在前)
+        snapshot = self._snapshot
+        block_size = bloomfilter.__REDIS_BLOCK_MAX_SIZE
+        pairs = list(map(self.__double_hash, datas))
+        result = [False] * len(datas)
+        for gen in self._generations:
+            k = gen['hash_func_num']
+            bits = self.__bits(datas if gen['hash_version'] == HASH_VERSION_LEGACY else pairs, gen)
+            blocks = [self._snapshot_blocks.get(key, (0, 0)) for key in gen['keys']]
+            for i in range(len(datas)):
+                if result[i]:
+                    continue
+                for bit in bits[i * k:(i + 1) * k]:
+                    offset, length = blocks[bit // block_size]
+                    bit %= block_size
+                    byte = bit >> 3
+                    if byte >= length or not snapshot[offset + byte] & (0x80 >> (bit & 7)):
+                        break
+                else:
+                    result[i] = True
+        return result
 
+    def close(self):
+        '''
+        关闭只读快照
+        '''
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
 
+    def clear(self, r):
+        for gen in self._generations:
+            for key in gen['keys']:
+                r.delete(key)
+        r.delete(self._key)
 
 
+class rotating_bloomfilter(object):
+    '''
+    按时间分片的bloomfilter: window 秒分为 slices 个时间片，每片一个 bloomfilter，
+    添加写入当前时间片，判断检查最近 slices 个时间片(一次往返)。
+    成员在 window - window/slices 到 window 秒后可以重新添加；过期的时间片由redis过期删除，内存不随时间增长。
+    '''
+
+    def __init__(self, r, task_id, window, slices=4, num_elements=10000, probability=0.001, scalable=False):
+        self._task_id = task_id
+        self._window = window
+        self._slices = max(int(slices), 1)
+        self._slice_len = float(window) / self._slices
+        self._num_elements = num_elements
+        self._probability = probability
+        self._scalable = scalable
+        self._index = None
+        self._current = None
+        self._previous = []
+        self.__rotate(r)
+
+    def __slice_id(self, index):
+        return "%s:w%d" % (self._task_id, index)
+
+    def __rotate(self, r):
+        index = int(time.time() // self._slice_len)
+        if index == self._index:
+            return
+        # 时间片在创建后 window + 一个时间片 内有效
+        ttl = int(math.ceil(self._window + self._slice_len))
+        self._current = bloomfilter(r, self.__slice_id(index), num_elements=self._num_elements,
+                                    probability=self._probability, ttl=ttl, scalable=self._scalable)
+        # 之前的时间片重新加载，不存在的跳过
+        self._previous = []
+        for i in range(index - self._slices + 1, index):
+            slice_id = self.__slice_id(i)
+            if r.exists("key:" + slice_id):
+                self._previous.append(bloomfilter(r, slice_id))
+        self._index = index
 
+    def add(self, r, data):
+        if isinstance(data, (list, tuple)):
+            return self.add_many(r, data)
+        return self.add_many(r, [data])[0]
 
+    def contains(self, r, data):
+        if isinstance(data, (list, tuple)):
+            return self.contains_many(r, data)
+        return self.contains_many(r, [data])[0]
 
+    def add_many(self, r, datas):
+        self.__rotate(r)
+        return self._current.add_many(r, datas, previous=self._previous)
 
+    def contains_many(self, r, datas):
+        self.__rotate(r)
+        return self._current.contains_many(r, datas, previous=self._previous)
 
+    def clear(self, r):
+        for bf in self._previous + [self._current]:
+            bf.clear(r)
@@ -1,5 +1,7 @@
 import redis
 import copy
+import threading
+import time
 from .global_value import gol
 
 REDIS_DEFAULT_CONFIG = {
@@ -13,9 +15,110 @@ REDIS_DEFAULT_CONFIG = {
     'max_connections': 100,
     'socket_keepalive': False,
     'socket_keepalive_options': False,
-    'retry_on_timeout': False
+    'retry_on_timeout': False,
+    'health_check_interval': 30,
 }
 
+# 等待空闲连接的默认超时(秒)，超时抛出 redis.ConnectionError
+POOL_TIMEOUT = 20
+
+# 进程内共享的连接池，key 为连接参数
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool that records how long callers waited for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredConnectionPool, self).__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.wait_max = 0.0
+        self.wait_timeouts = 0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.time()
+        timed_out = False
+        try:
+            return super(MeteredConnectionPool, self).get_connection(*args, **kwargs)
+        except redis.ConnectionError:
+            timed_out = time.time() - start >= self.timeout
+            raise
+        finally:
+            waited = time.time() - start
+            with self._metrics_lock:
+                self.wait_count += 1
+                self.wait_time += waited
+                self.wait_max = max(self.wait_max, waited)
+                if timed_out:
+                    self.wait_timeouts += 1
+
+    def metrics(self):
+        # 空闲连接在队列中，未创建的位置为None
+        try:
+            idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        except AttributeError:
+            idle = 0
+        created = len(self._connections)
+        with self._metrics_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': created,
+                'in_use': created - idle,
+                'idle': idle,
+                'wait_count': self.wait_count,
+                'wait_time': self.wait_time,
+                'wait_max': self.wait_max,
+                'wait_timeouts': self.wait_timeouts,
+            }
+
+
+def _pool_key(url, kwargs):
+    return repr((url, sorted(kwargs.items())))
+
+
+def get_pool(url=None, max_connections=REDIS_DEFAULT_CONFIG['max_connections'], timeout=POOL_TIMEOUT, **kwargs):
+    """Returns the process-wide pool for these connection parameters, creating it once.
+
+    Connections are reused LIFO, at most ``max_connections`` are opened and
+    callers wait up to ``timeout`` seconds for a free one. Connections idle
+    longer than ``health_check_interval`` seconds are pinged before use.
+    """
+    key = _pool_key(url, dict(kwargs, max_connections=max_connections, timeout=timeout))
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if url:
+                pool = MeteredConnectionPool.from_url(url, max_connections=max_connections, timeout=timeout,
+                                                      **kwargs)
+            else:
+                pool = MeteredConnectionPool(max_connections=max_connections, timeout=timeout, **kwargs)
+            _pools[key] = pool
+    return pool
+
+
+def pool_metrics():
+    """Returns the metrics of every shared pool, keyed by host:port/db"""
+    metrics = {}
+    for pool in list(_pools.values()):
+        kwargs = pool.connection_kwargs
+        name = '%s:%s/%s' % (kwargs.get('host', kwargs.get('path')), kwargs.get('port', ''), kwargs.get('db', 0))
+        metrics[name] = pool.metrics()
+    return metrics
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.disconnect()
+
 
 def init_redis(cfg):
     redis_cfg = copy.copy(REDIS_DEFAULT_CONFIG)
@@ -23,7 +126,7 @@ def init_redis(cfg):
         if key in cfg:
             redis_cfg[key] = cfg[key]
 
-    redis_pool = redis.ConnectionPool(**redis_cfg)
+    redis_pool = get_pool(**redis_cfg)
     gol.set_value('redis', redis_pool)
 
 
@@ -0,0 +1,272 @@
+"""A compact, versioned serializer for queued requests.
+
+Use it with ``SCHEDULER_SERIALIZER = 'scrapy_redis2.compactcompat'``.
+
+The dict built by ``request_to_dict`` and its ``crawler_scheduler`` are
+stored without their keys. When both have exactly the fields of their
+schema, which is the case for every request built by ``request_to_dict``
+and ``RequestTask``, the meta is stored next to two tuples with the other
+values in schema order, trailing values equal to their default left out
+(version 3). Otherwise only the fields that differ from their default are
+stored, by position, and unknown keys are stored as they are (version 1).
+Version 2 payloads, which stored every field as a list, are still read.
+Payloads larger than ``SCHEDULER_COMPRESS_THRESHOLD`` bytes are zlib
+compressed.
+
+Payload layout: ``MAGIC`` (2 bytes), version (1 byte), flags (1 byte), body.
+Anything not starting with ``MAGIC`` is read as a legacy ``picklecompat``
+payload, so queues can be migrated while old requests are still in them.
+
+Compared with ``picklecompat``, encoding is slightly slower and decoding
+clearly faster, a round trip is about 10% faster. Payloads are less than
+half as large: 214 bytes instead of 474 for a request with a few headers,
+meta with depth and a ``crawler_scheduler`` with params, 99 bytes instead
+of 394 for a bare one.
+"""
+import pickle
+import zlib
+from operator import itemgetter
+
+from . import picklecompat
+
+
+MAGIC = b'\xc5\x52'
+# 1: 只保存与默认值不同的字段(按位置); 2: 按schema顺序保存全部值(只读);
+# 3: 按schema顺序保存值，省略末尾的默认值
+VERSION = 3
+FLAG_ZLIB = 0x01
+
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+# request_to_dict 的字段及默认值，按位置编号，只能在末尾追加
+REQUEST_FIELDS = (
+    ('url', None),
+    ('callback', None),
+    ('errback', None),
+    ('method', 'GET'),
+    ('headers', {}),
+    ('body', b''),
+    ('cookies', {}),
+    ('meta', {}),
+    ('_encoding', 'utf-8'),
+    ('priority', 0),
+    ('dont_filter', False),
+    ('flags', []),
+    ('cb_kwargs', {}),
+)
+
+# meta['crawler_scheduler'] 的字段及默认值(参考 RequestTask.from_create)，只能在末尾追加
+TASK_FIELDS = (
+    ('task_id', None),
+    ('task_no', None),
+    ('depth', None),
+    ('priority', 4),
+    ('request_state', 0),
+    ('task_type', None),
+    ('callback', None),
+    ('errback', None),
+    ('worker_id', None),
+    ('create_time', None),
+    ('enqueue_time', None),
+    ('params', None),
+    ('ttl', None),
+)
+
+_REQUEST_INDEX = dict((name, (i, default)) for i, (name, default) in enumerate(REQUEST_FIELDS))
+_TASK_INDEX = dict((name, (i, default)) for i, (name, default) in enumerate(TASK_FIELDS))
+_REQUEST_NAMES = tuple(name for name, _ in REQUEST_FIELDS)
+_TASK_NAMES = tuple(name for name, _ in TASK_FIELDS)
+# version 3 中request的值不含meta，meta单独保存
+_REQUEST_VALUE_FIELDS = tuple(field for field in REQUEST_FIELDS if field[0] != 'meta')
+_REQUEST_DEFAULTS = tuple(default for _, default in _REQUEST_VALUE_FIELDS)
+_TASK_DEFAULTS = tuple(default for _, default in TASK_FIELDS)
+_request_values = itemgetter(*(name for name, _ in _REQUEST_VALUE_FIELDS))
+_task_values = itemgetter(*_TASK_NAMES)
+
+# 未压缩的当前版本数据头
+_HEADER = MAGIC + bytes(bytearray([VERSION, 0]))
+
+
+_MISSING = object()
+
+
+def _trim(values, defaults):
+    """Returns ``values`` without the trailing ones equal to their default."""
+    n = len(values)
+    while n and values[n - 1] == defaults[n - 1]:
+        n -= 1
+    return values[:n]
+
+
+# 以下两个函数的参数及默认值须与 REQUEST_FIELDS / TASK_FIELDS 一致，
+# 省略的末尾值由参数默认值补齐，可变的默认值每次新建
+def _request_from_values(meta, url=None, callback=None, errback=None, method='GET', headers=_MISSING,
+                         body=b'', cookies=_MISSING, _encoding='utf-8', priority=0, dont_filter=False,
+                         flags=_MISSING, cb_kwargs=_MISSING):
+    return {
+        'url': url,
+        'callback': callback,
+        'errback': errback,
+        'method': method,
+        'headers': {} if headers is _MISSING else headers,
+        'body': body,
+        'cookies': {} if cookies is _MISSING else cookies,
+        'meta': meta,
+        '_encoding': _encoding,
+        'priority': priority,
+        'dont_filter': dont_filter,
+        'flags': [] if flags is _MISSING else flags,
+        'cb_kwargs': {} if cb_kwargs is _MISSING else cb_kwargs,
+    }
+
+
+def _task_from_values(task_id=None, task_no=None, depth=None, priority=4, request_state=0, task_type=None,
+                      callback=None, errback=None, worker_id=None, create_time=None, enqueue_time=None,
+                      params=None, ttl=None):
+    return {
+        'task_id': task_id,
+        'task_no': task_no,
+        'depth': depth,
+        'priority': priority,
+        'request_state': request_state,
+        'task_type': task_type,
+        'callback': callback,
+        'errback': errback,
+        'worker_id': worker_id,
+        'create_time': create_time,
+        'enqueue_time': enqueue_time,
+        'params': params,
+        'ttl': ttl,
+    }
+
+
+def _from_values(meta, request, task):
+    meta['crawler_scheduler'] = _task_from_values(*task)
+    return _request_from_values(meta, *request)
+
+
+def _pack(obj, index):
+    """Returns ``(present, values, extra)``.
+
+    ``present`` is a bitmask of the schema fields found in ``obj``, ``values``
+    maps the position of the non-default ones to their value and ``extra``
+    holds keys outside of the schema.
+    """
+    present = 0
+    values = {}
+    extra = None
+    for name, value in obj.items():
+        field = index.get(name)
+        if field is None:
+            if extra is None:
+                extra = {}
+            extra[name] = value
+            continue
+        i, default = field
+        present |= 1 << i
+        if value != default:
+            values[i] = value
+    return present, values, extra
+
+
+def _unpack(packed, fields):
+    if isinstance(packed, list):
+        # version 2: 按schema顺序的全部值
+        return dict(zip((name for name, _ in fields), packed))
+    present, values, extra = packed
+    obj = {}
+    i = 0
+    while present:
+        if present & 1:
+            if i in values:
+                obj[fields[i][0]] = values[i]
+            else:
+                default = fields[i][1]
+                obj[fields[i][0]] = default.copy() if isinstance(default, (dict, list)) else default
+        present >>= 1
+        i += 1
+    if extra:
+        obj.update(extra)
+    return obj
+
+
+class CompactSerializer(object):
+
+    def __init__(self, compress_threshold=COMPRESS_THRESHOLD, compress_level=COMPRESS_LEVEL):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, obj):
+        try:
+            meta = obj['meta']
+            task = meta['crawler_scheduler']
+            # 字段数相同且都能取到即与schema完全一致
+            if len(obj) != len(_REQUEST_NAMES) or len(task) != len(_TASK_NAMES):
+                raise KeyError
+            request = _request_values(obj)
+            task = _task_values(task)
+        except (TypeError, KeyError):
+            version, body = 1, self._pack(obj)
+        else:
+            meta = meta.copy()
+            del meta['crawler_scheduler']
+            version, body = VERSION, (meta, _trim(request, _REQUEST_DEFAULTS), _trim(task, _TASK_DEFAULTS))
+        data = pickle.dumps(body, -1)
+        if self.compress_threshold and len(data) > self.compress_threshold:
+            return MAGIC + bytes(bytearray([version, FLAG_ZLIB])) + zlib.compress(data, self.compress_level)
+        if version == VERSION:
+            return _HEADER + data
+        return MAGIC + bytes(bytearray([version, 0])) + data
+
+    @staticmethod
+    def _pack(obj):
+        if isinstance(obj, dict) and isinstance(obj.get('meta'), dict):
+            meta = obj['meta']
+            task = meta.get('crawler_scheduler')
+            if isinstance(task, dict):
+                meta = dict(meta)
+                del meta['crawler_scheduler']
+                task = _pack(task, _TASK_INDEX)
+            else:
+                task = None
+            obj = dict(obj)
+            obj['meta'] = meta
+            return _pack(obj, _REQUEST_INDEX), task
+        # 非request数据原样保存
+        return None, obj
+
+    def loads(self, s):
+        if s[:4] == _HEADER:
+            return _from_values(*pickle.loads(s[4:]))
+        if s[:2] != MAGIC:
+            return picklecompat.loads(s)
+        version, flags = bytearray(s[2:4])
+        if version > VERSION:
+            raise ValueError("Unsupported compactcompat version: %d" % version)
+        data = s[4:]
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        if version == VERSION:
+            return _from_values(*pickle.loads(data))
+        request, task = pickle.loads(data)
+        if request is None:
+            return task
+        obj = _unpack(request, REQUEST_FIELDS)
+        if task is not None:
+            obj['meta'] = dict(obj['meta'])
+            obj['meta']['crawler_scheduler'] = _unpack(task, TASK_FIELDS)
+        return obj
+
+
+_default = CompactSerializer()
+
+loads = _default.loads
+dumps = _default.dumps
+
+
+def from_settings(settings):
+    """Returns a serializer configured by ``SCHEDULER_COMPRESS_THRESHOLD``."""
+    return CompactSerializer(
+        compress_threshold=settings.getint('SCHEDULER_COMPRESS_THRESHOLD', COMPRESS_THRESHOLD),
+    )
@@ -1,7 +1,12 @@
+import inspect
+
+import redis
 import six
 
 from scrapy.utils.misc import load_object
 
+from common import redis_pool
+
 from . import defaults
 
 
@@ -42,7 +47,8 @@ def get_redis_from_settings(settings):
     REDIS_ENCODING : str, optional
         Data encoding.
     REDIS_PARAMS : dict, optional
-        Additional client parameters.
+        Additional client parameters. ``max_connections``, ``pool_timeout``
+        and ``health_check_interval`` configure the shared connection pool.
 
     """
     params = defaults.REDIS_PARAMS.copy()
@@ -67,14 +73,27 @@ from_settings = get_redis_from_settings
 def get_redis(**kwargs):
     """Returns a redis client instance.
 
+    Clients built with the same parameters share one process-wide connection
+    pool from ``common.redis_pool``, so scheduler, spider and dupefilter of a
+    worker reuse the same connections.
+
     Parameters
     ----------
     redis_cls : class, optional
         Defaults to ``redis.StrictRedis``.
     url : str, optional
-        If given, ``redis_cls.from_url`` is used to instantiate the class.
+        Server connection URL.
+    max_connections : int, optional
+        Connections the shared pool opens at most.
+    pool_timeout : float, optional
+        Seconds to wait for a free connection before raising ``ConnectionError``.
+    connection_pool : ConnectionPool, optional
+        Use this pool instead of the shared one.
     **kwargs
-        Extra parameters to be passed to the ``redis_cls`` class.
+        Connection parameters, e.g. ``host``, ``port`` or ``socket_timeout``.
+        ``ssl`` and ``unix_socket_path`` select the connection class like
+        ``redis.Redis`` does. With parameters the connections do not accept
+        the client gets its own pool instead of the shared one.
 
     Returns
     -------
@@ -84,7 +103,42 @@ def get_redis(**kwargs):
     """
     redis_cls = kwargs.pop('redis_cls', defaults.REDIS_CLS)
     url = kwargs.pop('url', None)
-    if url:
-        return redis_cls.from_url(url, **kwargs)
-    else:
+    if 'connection_pool' in kwargs:
+        return redis_cls(connection_pool=kwargs['connection_pool'])
+    pool_kwargs = {}
+    if 'max_connections' in kwargs:
+        pool_kwargs['max_connections'] = kwargs.pop('max_connections')
+    if 'pool_timeout' in kwargs:
+        pool_kwargs['timeout'] = kwargs.pop('pool_timeout')
+    connection_kwargs = _connection_kwargs(kwargs)
+    if connection_kwargs is None:
+        # 连接池不接受的客户端参数，交给redis_cls自己建池
+        if 'max_connections' in pool_kwargs:
+            kwargs['max_connections'] = pool_kwargs['max_connections']
+        if url:
+            return redis_cls.from_url(url, **kwargs)
         return redis_cls(**kwargs)
+    pool = redis_pool.get_pool(url=url, **dict(connection_kwargs, **pool_kwargs))
+    return redis_cls(connection_pool=pool)
+
+
+def _connection_kwargs(kwargs):
+    """Translates client parameters into connection pool parameters.
+
+    Returns None if some parameter is not accepted by the connection class.
+    """
+    kwargs = dict(kwargs)
+    if kwargs.pop('ssl', False):
+        kwargs['connection_class'] = redis.SSLConnection
+    if 'unix_socket_path' in kwargs:
+        kwargs['path'] = kwargs.pop('unix_socket_path')
+        kwargs['connection_class'] = redis.UnixDomainSocketConnection
+    connection_class = kwargs.get('connection_class', redis.Connection)
+    params = set(['connection_class'])
+    for cls in inspect.getmro(connection_class):
+        init = cls.__dict__.get('__init__')
+        if init is not None:
+            params.update(inspect.signature(init).parameters)
+    if any(key not in params for key in kwargs):
+        return None
+    return kwargs
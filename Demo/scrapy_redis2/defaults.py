@@ -9,7 +9,77 @@ REDIS_PARAMS = {
     'socket_connect_timeout': 30,
     'retry_on_timeout': True,
     'encoding': REDIS_ENCODING,
+    # Shared per-process pool (common.redis_pool): size, seconds to wait for
+    # a free connection and idle seconds after which a connection is pinged.
+    'max_connections': 50,
+    'pool_timeout': 20,
+    'health_check_interval': 30,
 }
 
 SCHEDULER_IDLE_BEFORE_CLOSE = 1
 
+# Back off polling empty queues, woken up by pushes published on a pub/sub channel.
+SCHEDULER_IDLE_BACKOFF = False
+SCHEDULER_IDLE_MIN_DELAY = 1
+SCHEDULER_IDLE_MAX_DELAY = 30
+
+# Run redis calls in dedicated threads instead of the reactor thread.
+SCHEDULER_ASYNC_IO = True
+
+# Push locally generated requests straight onto the priority queues.
+SCHEDULER_DIRECT_ENQUEUE = False
+
+# Keep popped requests in a per-worker lease until they are acknowledged.
+SCHEDULER_RELIABLE_QUEUE = False
+SCHEDULER_LEASE_TIMEOUT = 600
+SCHEDULER_LEASE_REAP_INTERVAL = 60
+
+# Split the priority lists by 'spider' name or 'task_type'; 'global' shares them.
+SCHEDULER_QUEUE_ROUTING = 'global'
+
+# Seconds the pipelined queue depths are cached for len(queue).
+SCHEDULER_QUEUE_DEPTH_TTL = 1.0
+
+# Split every priority list into per task_id sub-queues popped round-robin.
+SCHEDULER_QUEUE_FAIR = False
+
+# Queue used by scheduler, spider and seed loader.
+SCHEDULER_QUEUE_CLASS = 'scrapy_redis2.queue.SpiderPriorityQueue'
+# SortedPriorityQueue: seconds of waiting worth one priority level, 0 disables aging.
+SCHEDULER_QUEUE_AGING = 0
+
+# Delay retried requests with exponential backoff; 0 hands them to the dispatcher at once.
+SCHEDULER_RETRY_DELAY = 0
+SCHEDULER_RETRY_DELAY_FACTOR = 2
+SCHEDULER_RETRY_DELAY_MAX = 600
+SCHEDULER_RETRY_PROMOTE_INTERVAL = 1
+SCHEDULER_RETRY_PROMOTE_BATCH = 1000
+
+# Wrap queued requests in an envelope header; 0 ttl means never expire.
+SCHEDULER_ENVELOPE = False
+SCHEDULER_REQUEST_TTL = 0
+
+# Buffered state reporting to processed_queue.
+SCHEDULER_STATE_FLUSH_SIZE = 100
+SCHEDULER_STATE_FLUSH_INTERVAL = 1.0
+SCHEDULER_STATE_BUFFER_MAX_BYTES = 16 * 1024 * 1024
+
+# Report completed/failed requests as slim records on state_queue.
+SCHEDULER_STATE_EVENTS = False
+
+# Per task_id bloom filters used by RFPDupeFilter.
+DUPEFILTER_NUM_ELEMENTS = 10000
+DUPEFILTER_PROBABILITY = 0.001
+DUPEFILTER_TTL = 3600
+# Chain larger filters once a task outgrows DUPEFILTER_NUM_ELEMENTS.
+DUPEFILTER_SCALABLE = True
+# Fingerprint strategy: 'scrapy', 'url' or a path to a function.
+DUPEFILTER_FINGERPRINT = 'scrapy'
+# Local LRU of recently seen fingerprints in front of the bloom filters.
+DUPEFILTER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Rotating time-sliced filters; 0 keeps a single filter expiring after DUPEFILTER_TTL.
+DUPEFILTER_WINDOW = 0
+DUPEFILTER_WINDOW_SLICES = 4
+# Requests yielded by a callback checked against the dupefilter per round trip.
+DUPEFILTER_BATCH_SIZE = 500
+
@@ -1,38 +1,155 @@
 import logging
+import sys
+import time
+from collections import OrderedDict
 
 
 from scrapy.dupefilters import BaseDupeFilter
-from scrapy.utils.request import request_fingerprint
+
+from common.redis_bloomfilter import bloomfilter, rotating_bloomfilter
+
+from . import defaults
+from .fingerprint import Fingerprinter, get_fingerprinter_from_settings
+from .request_task import RequestTask
 
 
 logger = logging.getLogger(__name__)
 
 
+class FingerprintCache(object):
+    """LRU set of recently seen ``(task_id, fingerprint)`` pairs bounded by an
+    estimate of its memory use. Entries older than ``max_age`` seconds are
+    treated as missing."""
+
+    # OrderedDict节点、key元组及时间的大致开销
+    ENTRY_OVERHEAD = 184
+
+    def __init__(self, max_bytes, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        # key -> 加入时间
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        added = self.entries.get(key)
+        if added is None:
+            return False
+        if self.max_age is not None and added + self.max_age < time.time():
+            del self.entries[key]
+            self.size -= self._entry_size(key)
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def add(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = time.time()
+        self.size += self._entry_size(key)
+        while self.size > self.max_bytes and self.entries:
+            old, _ = self.entries.popitem(last=False)
+            self.size -= self._entry_size(old)
+
+    def _entry_size(self, key):
+        return self.ENTRY_OVERHEAD + sys.getsizeof(key[1])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
 # TODO: Rename class to RedisDupeFilter.
 class RFPDupeFilter(BaseDupeFilter):
     """Redis-based request duplicates filter.
 
+    Fingerprints are kept in one ``common.redis_bloomfilter.bloomfilter`` per
+    ``task_id``, so the same url is only fetched once per task across all
+    workers. Requests without a ``task_id`` are never filtered.
+
     This class can also be used with default Scrapy's scheduler.
 
+    Settings
+    --------
+    DUPEFILTER_FINGERPRINT : str (default: "scrapy")
+        Fingerprint strategy, see ``scrapy_redis2.fingerprint``.
+    DUPEFILTER_NUM_ELEMENTS : int (default: 10000)
+        Expected number of requests per task.
+    DUPEFILTER_SCALABLE : bool (default: True)
+        Add larger filter generations when a task outgrows
+        ``DUPEFILTER_NUM_ELEMENTS``, keeping the false positive bound.
+    DUPEFILTER_PROBABILITY : float (default: 0.001)
+        False positive rate of the bloom filters.
+    DUPEFILTER_TTL : int (default: 3600)
+        Seconds a task's bloom filter is kept in redis.
+    DUPEFILTER_CACHE_MAX_BYTES : int (default: 32MB)
+        Memory for the local cache of recently seen fingerprints, which answers
+        repeated links without a redis round trip. 0 disables it.
+    DUPEFILTER_WINDOW : int (default: 0)
+        When set, fingerprints are kept in rotating time-sliced filters and a
+        url may be fetched again after about this many seconds (between
+        ``window - window / slices`` and ``window``). ``DUPEFILTER_TTL`` is
+        not used then.
+    DUPEFILTER_WINDOW_SLICES : int (default: 4)
+        Number of time slices per window.
+
     """
 
     logger = logger
 
-    def __init__(self, debug=False):
+    # 缓存的bloomfilter个数
+    max_filters = 1024
+
+    def __init__(self, server=None, debug=False, num_elements=defaults.DUPEFILTER_NUM_ELEMENTS,
+                 probability=defaults.DUPEFILTER_PROBABILITY, ttl=defaults.DUPEFILTER_TTL,
+                 scalable=defaults.DUPEFILTER_SCALABLE, cache_max_bytes=defaults.DUPEFILTER_CACHE_MAX_BYTES,
+                 window=defaults.DUPEFILTER_WINDOW, window_slices=defaults.DUPEFILTER_WINDOW_SLICES,
+                 fingerprinter=None):
         """Initialize the duplicates filter.
 
         Parameters
         ----------
-        server : redis.StrictRedis
-            The redis server instance.
-        key : str
-            Redis key Where to store fingerprints.
+        server : redis.StrictRedis, optional
+            The redis server instance. Nothing is filtered without it.
         debug : bool, optional
             Whether to log filtered requests.
+        num_elements : int
+            Expected number of requests per task.
+        probability : float
+            False positive rate of the bloom filters.
+        ttl : int
+            Seconds a task's bloom filter is kept in redis.
+        scalable : bool
+            Whether new bloom filters grow past ``num_elements``.
+        cache_max_bytes : int
+            Memory for the local fingerprint cache, 0 disables it.
+        window : int
+            Seconds after which a url may be fetched again, 0 disables it.
+        window_slices : int
+            Number of time slices per window.
+        fingerprinter : fingerprint.Fingerprinter, optional
+            Memoized fingerprint strategy, Scrapy's by default.
 
         """
+        self.server = server
+        self.fingerprinter = fingerprinter or Fingerprinter()
         self.debug = debug
         self.logdupes = True
+        self.num_elements = num_elements
+        self.probability = probability
+        self.ttl = ttl
+        self.scalable = scalable
+        # task_id -> (bloomfilter, 创建时间)
+        self.filters = OrderedDict()
+        self.window = window
+        self.window_slices = window_slices
+        # 时间窗口模式下缓存最多保留一个时间片
+        max_age = float(window) / window_slices if window else None
+        self.cache = FingerprintCache(cache_max_bytes, max_age=max_age) if cache_max_bytes > 0 else None
 
     @classmethod
     def from_settings(cls, settings):
@@ -53,8 +170,28 @@ class RFPDupeFilter(BaseDupeFilter):
 
 
         """
-        debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(debug=debug)
+        from . import connection
+        server = connection.from_settings(settings)
+        return cls(server=server, **cls._settings_kwargs(settings))
+
+    @classmethod
+    def from_spider(cls, server, spider):
+        """Returns an instance sharing ``server`` with the scheduler or spider."""
+        return cls(server=server, **cls._settings_kwargs(spider.settings))
+
+    @staticmethod
+    def _settings_kwargs(settings):
+        return {
+            'debug': settings.getbool('DUPEFILTER_DEBUG'),
+            'num_elements': settings.getint('DUPEFILTER_NUM_ELEMENTS', defaults.DUPEFILTER_NUM_ELEMENTS),
+            'probability': settings.getfloat('DUPEFILTER_PROBABILITY', defaults.DUPEFILTER_PROBABILITY),
+            'ttl': settings.getint('DUPEFILTER_TTL', defaults.DUPEFILTER_TTL),
+            'scalable': settings.getbool('DUPEFILTER_SCALABLE', defaults.DUPEFILTER_SCALABLE),
+            'cache_max_bytes': settings.getint('DUPEFILTER_CACHE_MAX_BYTES', defaults.DUPEFILTER_CACHE_MAX_BYTES),
+            'window': settings.getint('DUPEFILTER_WINDOW', defaults.DUPEFILTER_WINDOW),
+            'window_slices': settings.getint('DUPEFILTER_WINDOW_SLICES', defaults.DUPEFILTER_WINDOW_SLICES),
+            'fingerprinter': get_fingerprinter_from_settings(settings),
+        }
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -84,7 +221,70 @@ class RFPDupeFilter(BaseDupeFilter):
         bool
 
         """
-        return False
+        return self.requests_seen([request])[0]
+
+    def requests_seen(self, requests):
+        """Returns for each request whether it was already seen, and marks
+        all of them as seen.
+
+        Fingerprints found in the local cache are answered directly, the rest
+        are grouped by ``task_id`` and each group is checked with a single
+        redis round trip.
+
+        Parameters
+        ----------
+        requests : list of scrapy.http.Request
+
+        Returns
+        -------
+        list of bool
+
+        """
+        result = [False] * len(requests)
+        if self.server is None:
+            return result
+        cache = self.cache
+        groups = OrderedDict()
+        for i, request in enumerate(requests):
+            task_id = RequestTask.from_request(request).task_id
+            if task_id is None:
+                continue
+            # 同一批次内重复的只保留第一个
+            fps = groups.setdefault(task_id, OrderedDict())
+            fp = self.request_fingerprint(request)
+            if fp in fps or (cache is not None and (task_id, fp) in cache):
+                result[i] = True
+            else:
+                fps[fp] = i
+        for task_id, fps in groups.items():
+            if not fps:
+                continue
+            seen = self._get_filter(task_id).add_many(self.server, list(fps))
+            for i, val in zip(fps.values(), seen):
+                result[i] = val
+            if cache is not None:
+                for fp in fps:
+                    cache.add((task_id, fp))
+        return result
+
+    def _get_filter(self, task_id):
+        task_id = str(task_id)
+        now = time.time()
+        entry = self.filters.pop(task_id, None)
+        if self.window:
+            # 按时间片轮换，由 rotating_bloomfilter 自己切换
+            if entry is None:
+                entry = (rotating_bloomfilter(self.server, task_id, self.window, slices=self.window_slices,
+                                              num_elements=self.num_elements, probability=self.probability,
+                                              scalable=self.scalable), now)
+        # redis中的bloomfilter过期后重新加载
+        elif entry is None or entry[1] + self.ttl < now:
+            entry = (bloomfilter(self.server, task_id, num_elements=self.num_elements,
+                                 probability=self.probability, ttl=self.ttl, scalable=self.scalable), now)
+        self.filters[task_id] = entry
+        while len(self.filters) > self.max_filters:
+            self.filters.popitem(last=False)
+        return entry[0]
 
     def request_fingerprint(self, request):
         """Returns a fingerprint for a given request.
@@ -98,7 +298,7 @@ class RFPDupeFilter(BaseDupeFilter):
         str
 
         """
-        return request_fingerprint(request)
+        return self.fingerprinter(request)
 
     def close(self, reason=''):
         """Delete data on close. Called by Scrapy's scheduler.
@@ -112,7 +312,11 @@ class RFPDupeFilter(BaseDupeFilter):
 
     def clear(self):
         """Clears fingerprints data."""
-        pass
+        for bf, _ in self.filters.values():
+            bf.clear(self.server)
+        self.filters.clear()
+        if self.cache is not None:
+            self.cache.clear()
 
     def log(self, request, spider):
         """Logs given request.
@@ -124,8 +328,9 @@ class RFPDupeFilter(BaseDupeFilter):
 
         """
         if self.debug:
-            msg = "Filtered duplicate request: %(request)s"
-            self.logger.debug(msg, {'request': request}, extra={'spider': spider})
+            msg = "Filtered duplicate request: %(request)s (fingerprint: %(fingerprint)s)"
+            args = {'request': request, 'fingerprint': self.request_fingerprint(request)}
+            self.logger.debug(msg, args, extra={'spider': spider})
         elif self.logdupes:
             msg = ("Filtered duplicate request %(request)s"
                    " - no more duplicates will be shown"
@@ -0,0 +1,91 @@
+"""Envelope around queued requests with a header readable without decoding.
+
+Layout::
+
+    MAGIC (2 bytes) | version (1) | priority (1, signed) | create_time (4) | ttl (4)
+    | task_id | task_type | callback | body
+
+``task_id``, ``task_type`` and ``callback`` are utf-8 strings prefixed with
+their length (2 bytes, 0xFFFF for None). ``body`` is the serializer output.
+Payloads without ``MAGIC`` are returned unchanged by ``unwrap`` with a
+``None`` header, so queues written before the envelope keep working.
+"""
+import struct
+import time
+from collections import namedtuple
+
+
+MAGIC = b'\xc5\x45'
+VERSION = 1
+
+_HEADER = struct.Struct('>2sBbII')
+_LENGTH = struct.Struct('>H')
+_NONE = 0xFFFF
+
+
+class EnvelopeHeader(namedtuple('EnvelopeHeader', 'task_id task_type priority callback create_time ttl')):
+    __slots__ = ()
+
+    def expired(self, now=None):
+        """Returns True if the request outlived its ttl (0 means never)."""
+        if not self.ttl or not self.create_time:
+            return False
+        if now is None:
+            now = time.time()
+        return self.create_time + self.ttl < now
+
+
+def _pack_str(value):
+    if value is None:
+        return _LENGTH.pack(_NONE)
+    value = value.encode('utf-8') if not isinstance(value, bytes) else value
+    return _LENGTH.pack(len(value)) + value
+
+
+def _unpack_str(data, offset):
+    length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    if length == _NONE:
+        return None, offset
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def wrap(body, task, ttl=0):
+    """Returns ``body`` wrapped with a header built from a ``RequestTask``.
+
+    ``task.ttl`` takes precedence over the ``ttl`` argument.
+    """
+    try:
+        priority = min(max(int(task.priority), -128), 127)
+    except (TypeError, ValueError):
+        priority = 4
+    ttl = task.ttl if task.ttl is not None else ttl
+    task_id = task.task_id
+    task_type = task.task_type
+    return b''.join([
+        _HEADER.pack(MAGIC, VERSION, priority, int(task.create_time or 0), int(ttl or 0)),
+        _pack_str(None if task_id is None else str(task_id)),
+        _pack_str(None if task_type is None else str(task_type)),
+        _pack_str(task.callback),
+        body,
+    ])
+
+
+def unwrap(data):
+    """Returns ``(header, body)``; ``header`` is None for payloads without envelope."""
+    if data[:2] != MAGIC:
+        return None, data
+    _, version, priority, create_time, ttl = _HEADER.unpack_from(data, 0)
+    if version > VERSION:
+        raise ValueError("Unsupported envelope version: %d" % version)
+    offset = _HEADER.size
+    task_id, offset = _unpack_str(data, offset)
+    task_type, offset = _unpack_str(data, offset)
+    callback, offset = _unpack_str(data, offset)
+    header = EnvelopeHeader(task_id, task_type, priority, callback, create_time, ttl)
+    return header, data[offset:]
+
+
+def read_header(data):
+    """Returns the envelope header of ``data`` or None."""
+    return unwrap(data)[0]
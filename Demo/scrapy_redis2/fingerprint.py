@@ -0,0 +1,60 @@
+"""Request fingerprint strategies for dedup and state records.
+
+``DUPEFILTER_FINGERPRINT`` selects one:
+
+``scrapy``
+    Scrapy's ``request_fingerprint``: sha1 of method, canonical url and body.
+``url``
+    blake2b (16 bytes) of the url as is, without canonicalization. Much
+    cheaper, but requests that only differ in method, body or query order
+    are treated as different or equal exactly as their url string is.
+
+or a path to a function taking a request and returning a str.
+"""
+import hashlib
+from weakref import WeakKeyDictionary
+
+import six
+
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes
+from scrapy.utils.request import request_fingerprint
+
+from . import defaults
+
+
+def scrapy_fingerprint(request):
+    return request_fingerprint(request)
+
+
+def url_fingerprint(request):
+    return hashlib.blake2b(to_bytes(request.url), digest_size=16).hexdigest()
+
+
+STRATEGIES = {
+    'scrapy': scrapy_fingerprint,
+    'url': url_fingerprint,
+}
+
+
+class Fingerprinter(object):
+    """Computes a request's fingerprint once and remembers it for as long as
+    the request is alive, so the dupefilter, state records and logs share it."""
+
+    def __init__(self, func=scrapy_fingerprint):
+        self.func = func
+        self.cache = WeakKeyDictionary()
+
+    def __call__(self, request):
+        fp = self.cache.get(request)
+        if fp is None:
+            fp = self.cache[request] = self.func(request)
+        return fp
+
+
+def get_fingerprinter_from_settings(settings):
+    """Returns a ``Fingerprinter`` for the ``DUPEFILTER_FINGERPRINT`` strategy."""
+    strategy = settings.get('DUPEFILTER_FINGERPRINT') or defaults.DUPEFILTER_FINGERPRINT
+    if isinstance(strategy, six.string_types):
+        strategy = STRATEGIES.get(strategy) or load_object(strategy)
+    return Fingerprinter(strategy)
@@ -1,13 +1,378 @@
+import random
+import time
+from collections import OrderedDict
+
 from scrapy.utils.reqser import request_to_dict, request_from_dict
 
-from . import picklecompat
+from . import defaults, envelope, picklecompat
+from .request_task import RequestTask
 from .task_defined import TASK_QUEUE_KEY
+from .utils import get_serializer_from_settings
+from .wakeup import publish_wakeup
+
+
+# 按优先级顺序(KEYS)依次RPOP，返回第一个命中的数据
+PRIORITY_POP_SCRIPT = """
+for i = 1, #KEYS do
+    local data = redis.call('RPOP', KEYS[i])
+    if data then
+        return data
+    end
+end
+return false
+"""
+
+# 按优先级顺序(KEYS)依次RPOP，最多返回 ARGV[1] 条数据
+PRIORITY_POP_MANY_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local result = {}
+for i = 1, #KEYS do
+    while #result < limit do
+        local data = redis.call('RPOP', KEYS[i])
+        if not data then
+            break
+        end
+        result[#result + 1] = data
+    end
+    if #result >= limit then
+        break
+    end
+end
+return result
+"""
+
+# 可靠模式出队: 按优先级最多取 ARGV[1] 条，同时记录到worker的租约中
+# KEYS: inflight_queue, inflight_data, inflight_workers, lease_seq, 优先级队列...
+# ARGV: limit, 租约到期时间, worker_id
+# 返回: {token1, data1, token2, data2, ...}
+RELIABLE_POP_MANY_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local result = {}
+local count = 0
+for i = 5, #KEYS do
+    while count < limit do
+        local data = redis.call('RPOP', KEYS[i])
+        if not data then
+            break
+        end
+        local token = tostring(redis.call('INCR', KEYS[4]))
+        redis.call('ZADD', KEYS[1], ARGV[2], token)
+        redis.call('HSET', KEYS[2], token, data, token .. ':q', KEYS[i])
+        result[#result + 1] = token
+        result[#result + 1] = data
+        count = count + 1
+    end
+    if count >= limit then
+        break
+    end
+end
+if count > 0 then
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+return result
+"""
+
+# 公平模式: 优先级队列 base 拆分为每个task_id的子队列 base:task:<task_id>，
+# base:tasks 为非空子队列的task_id环(尾部出队)，base:credit 记录当前task本轮已出队数。
+# fair_pop 从环尾的task出队一条，达到其权重后把它转到环头，子队列为空时移出环。
+# 外部直接写入 base 的数据作为task_id为空串的伪task参与轮转，base非空而不在环中时加入环头。
+FAIR_POP_FUNCTION = """
+local function fair_pop(base, weights)
+    local ring = base .. ':tasks'
+    local credit = base .. ':credit'
+    if redis.call('LLEN', base) > 0 and not redis.call('LPOS', ring, '') then
+        redis.call('LPUSH', ring, '')
+    end
+    while true do
+        local task = redis.call('LINDEX', ring, -1)
+        if not task then
+            return false
+        end
+        local sub = base .. ':task:' .. task
+        if task == '' then
+            sub = base
+        end
+        local data = redis.call('RPOP', sub)
+        if data and redis.call('LLEN', sub) > 0 then
+            local weight = tonumber(redis.call('HGET', weights, task)) or 1
+            if weight <= 1 or redis.call('HINCRBY', credit, task, 1) >= weight then
+                redis.call('HDEL', credit, task)
+                redis.call('RPOPLPUSH', ring, ring)
+            end
+        else
+            redis.call('RPOP', ring)
+            redis.call('HDEL', credit, task)
+        end
+        if data then
+            return {task, data}
+        end
+    end
+end
+"""
+
+# 公平模式入队，子队列由空变为非空时task_id加入环头(放回的数据加入环尾，下一个出队)
+# KEYS: 优先级队列 ; ARGV: task_id, head|tail, data...
+FAIR_PUSH_SCRIPT = """
+local sub = KEYS[1] .. ':task:' .. ARGV[1]
+local cmd = 'LPUSH'
+if ARGV[2] == 'tail' then
+    cmd = 'RPUSH'
+end
+local len = 0
+for i = 3, #ARGV, 1000 do
+    len = redis.call(cmd, sub, unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+if len == #ARGV - 2 then
+    redis.call(cmd, KEYS[1] .. ':tasks', ARGV[1])
+end
+return len
+"""
+
+# 公平模式按优先级最多取 ARGV[1] 条; KEYS: task_weights, 优先级队列...
+FAIR_POP_MANY_SCRIPT = FAIR_POP_FUNCTION + """
+local limit = tonumber(ARGV[1])
+local result = {}
+for i = 2, #KEYS do
+    while #result < limit do
+        local item = fair_pop(KEYS[i], KEYS[1])
+        if not item then
+            break
+        end
+        result[#result + 1] = item[2]
+    end
+    if #result >= limit then
+        break
+    end
+end
+return result
+"""
+
+# 公平模式的可靠出队，租约中另外记录task_id(token:t)，取自优先级队列本身的数据没有token:t
+# KEYS: inflight_queue, inflight_data, inflight_workers, lease_seq, task_weights, 优先级队列...
+# ARGV: limit, 租约到期时间, worker_id
+FAIR_RELIABLE_POP_MANY_SCRIPT = FAIR_POP_FUNCTION + """
+local limit = tonumber(ARGV[1])
+local result = {}
+local count = 0
+for i = 6, #KEYS do
+    while count < limit do
+        local item = fair_pop(KEYS[i], KEYS[5])
+        if not item then
+            break
+        end
+        local token = tostring(redis.call('INCR', KEYS[4]))
+        redis.call('ZADD', KEYS[1], ARGV[2], token)
+        redis.call('HSET', KEYS[2], token, item[2], token .. ':q', KEYS[i])
+        if item[1] ~= '' then
+            redis.call('HSET', KEYS[2], token .. ':t', item[1])
+        end
+        result[#result + 1] = token
+        result[#result + 1] = item[2]
+        count = count + 1
+    end
+    if count >= limit then
+        break
+    end
+end
+if count > 0 then
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+return result
+"""
+
+# 租约放回来源队列头部: ARGV[3..] 指定token，否则放回已到期(score <= ARGV[1])的最多 ARGV[2] 条
+# 公平模式的租约(有token:t)放回对应子队列，有序集合的租约(有token:s)按原score及序号放回
+# KEYS: inflight_queue, inflight_data, inflight_workers ; ARGV: now, limit, worker_id, token...
+RELIABLE_REQUEUE_SCRIPT = """
+local tokens
+if #ARGV > 3 then
+    tokens = {}
+    for i = 4, #ARGV do
+        tokens[#tokens + 1] = ARGV[i]
+    end
+else
+    tokens = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+end
+local count = 0
+for _, token in ipairs(tokens) do
+    local data = redis.call('HGET', KEYS[2], token)
+    local key = redis.call('HGET', KEYS[2], token .. ':q')
+    local task = redis.call('HGET', KEYS[2], token .. ':t')
+    local score = redis.call('HGET', KEYS[2], token .. ':s')
+    if data and key then
+        if task then
+            if redis.call('RPUSH', key .. ':task:' .. task, data) == 1 then
+                redis.call('RPUSH', key .. ':tasks', task)
+            end
+        elseif score then
+            redis.call('ZADD', key, score, (redis.call('HGET', KEYS[2], token .. ':m') or '') .. data)
+        else
+            redis.call('RPUSH', key, data)
+        end
+        count = count + 1
+    end
+    redis.call('ZREM', KEYS[1], token)
+    redis.call('HDEL', KEYS[2], token, token .. ':q', token .. ':t', token .. ':s', token .. ':m')
+end
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+return count
+"""
+
+# SortedPriorityQueue 出队: 返回 {key, member, score} 列表，单个有序集合时直接ZPOPMIN，
+# 多个时每次取各集合中 (score, member) 最小的一条
+SORTED_POP_FUNCTION = """
+local function sorted_pop_many(first, limit)
+    local items = {}
+    if first == #KEYS then
+        local popped = redis.call('ZPOPMIN', KEYS[first], limit)
+        for i = 1, #popped, 2 do
+            items[#items + 1] = {KEYS[first], popped[i], popped[i + 1]}
+        end
+        return items
+    end
+    while #items < limit do
+        local best
+        for i = first, #KEYS do
+            local head = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+            if head[1] then
+                local score = tonumber(head[2])
+                if not best or score < best[4] or (score == best[4] and head[1] < best[2]) then
+                    best = {KEYS[i], head[1], head[2], score}
+                end
+            end
+        end
+        if not best then
+            break
+        end
+        redis.call('ZREM', best[1], best[2])
+        items[#items + 1] = best
+    end
+    return items
+end
+"""
+
+# 成员为16位十六进制入队序号 + 数据，同score时按入队顺序出队
+SORTED_SEQ_WIDTH = 16
+
+# KEYS: 有序集合, sorted_seq, sorted_head_seq ; ARGV: head|tail, score1, data1, score2, data2...
+# head 时序号为 '-' 加15位十六进制的递减序号: '-' 小于所有十六进制数字，排在同score的数据之前，
+# 与列表的RPUSH相同，每条都排在之前放回的数据之前
+SORTED_PUSH_SCRIPT = """
+local n = (#ARGV - 1) / 2
+local fmt = '%016x'
+local seq, step
+if ARGV[1] == 'head' then
+    fmt = '-%015x'
+    seq = 4503599627370496 - (redis.call('INCRBY', KEYS[3], n) - n) - 1
+    step = -1
+else
+    seq = redis.call('INCRBY', KEYS[2], n) - n
+    step = 1
+end
+for i = 1, n do
+    redis.call('ZADD', KEYS[1], ARGV[2 * i], string.format(fmt, seq) .. ARGV[2 * i + 1])
+    seq = seq + step
+end
+return n
+"""
+
+# KEYS: 有序集合... ; ARGV: limit
+SORTED_POP_MANY_SCRIPT = SORTED_POP_FUNCTION + """
+local result = {}
+for _, item in ipairs(sorted_pop_many(1, tonumber(ARGV[1]))) do
+    result[#result + 1] = string.sub(item[2], 17)
+end
+return result
+"""
+
+# 可靠出队，租约中另外记录score(token:s)及序号(token:m)
+# KEYS: inflight_queue, inflight_data, inflight_workers, lease_seq, 有序集合...
+# ARGV: limit, 租约到期时间, worker_id
+SORTED_RELIABLE_POP_MANY_SCRIPT = SORTED_POP_FUNCTION + """
+local result = {}
+for _, item in ipairs(sorted_pop_many(5, tonumber(ARGV[1]))) do
+    local data = string.sub(item[2], 17)
+    local token = tostring(redis.call('INCR', KEYS[4]))
+    redis.call('ZADD', KEYS[1], ARGV[2], token)
+    redis.call('HSET', KEYS[2], token, data, token .. ':q', item[1],
+               token .. ':s', item[3], token .. ':m', string.sub(item[2], 1, 16))
+    result[#result + 1] = token
+    result[#result + 1] = data
+end
+if #result > 0 then
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+return result
+"""
+
+# 延迟队列入队; KEYS: delay_queue, delay_data, delay_seq
+# ARGV: 每条5个参数 到期时间, 目标队列, task_id(公平模式), score(有序集合), data
+DELAY_PUSH_SCRIPT = """
+local n = #ARGV / 5
+local seq = redis.call('INCRBY', KEYS[3], n) - n
+for i = 0, n - 1 do
+    local token = tostring(seq + i + 1)
+    redis.call('ZADD', KEYS[1], ARGV[5 * i + 1], token)
+    redis.call('HSET', KEYS[2], token, ARGV[5 * i + 5], token .. ':q', ARGV[5 * i + 2])
+    if ARGV[5 * i + 3] ~= '' then
+        redis.call('HSET', KEYS[2], token .. ':t', ARGV[5 * i + 3])
+    end
+    if ARGV[5 * i + 4] ~= '' then
+        redis.call('HSET', KEYS[2], token .. ':s', ARGV[5 * i + 4])
+    end
+end
+return n
+"""
+
+# 把到期(score <= ARGV[1])的最多 ARGV[2] 条移到目标队列尾部(与正常入队相同)
+# KEYS: delay_queue, delay_data, sorted_seq ; ARGV: now, limit
+DELAY_PROMOTE_SCRIPT = """
+local tokens = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local count = 0
+for _, token in ipairs(tokens) do
+    local fields = redis.call('HMGET', KEYS[2], token, token .. ':q', token .. ':t', token .. ':s')
+    local data, key, task, score = fields[1], fields[2], fields[3], fields[4]
+    if data and key then
+        if task then
+            if redis.call('LPUSH', key .. ':task:' .. task, data) == 1 then
+                redis.call('LPUSH', key .. ':tasks', task)
+            end
+        elseif score then
+            redis.call('ZADD', key, score, string.format('%016x', redis.call('INCR', KEYS[3])) .. data)
+        else
+            redis.call('LPUSH', key, data)
+        end
+        count = count + 1
+    end
+    redis.call('ZREM', KEYS[1], token)
+    redis.call('HDEL', KEYS[2], token, token .. ':q', token .. ':t', token .. ':s')
+end
+return count
+"""
+
+# request.meta 中保存租约token的key
+LEASE_META_KEY = 'scheduler_lease'
+
+# SCHEDULER_QUEUE_ROUTING 的取值
+ROUTING_GLOBAL = 'global'
+ROUTING_SPIDER = 'spider'
+ROUTING_TASK_TYPE = 'task_type'
+ROUTINGS = (ROUTING_GLOBAL, ROUTING_SPIDER, ROUTING_TASK_TYPE)
+# 没有 task_type 的请求所在的命名空间
+DEFAULT_NAMESPACE = 'default'
+# 公平模式及可靠模式下阻塞出队的轮询间隔(秒)
+POLL_INTERVAL = 0.1
 
 
 class Base(object):
     """Per-spider base queue class"""
 
-    def __init__(self, server, spider):
+    # header_filter(header, body) -> bool，返回False时丢弃该request，不做完整解码
+    header_filter = None
+
+    def __init__(self, server, spider, serializer=None, use_envelope=False, request_ttl=0):
         """Initialize per-spider redis queue.
 
         Parameters
@@ -16,19 +381,44 @@ class Base(object):
             Redis client instance.
         spider : Spider
             Scrapy spider instance.
+        serializer : object
+            Serializer object with ``loads`` and ``dumps`` methods.
+        use_envelope : bool
+            Wrap encoded requests in an ``envelope`` header.
+        request_ttl : int
+            Default ttl written to the envelope header, 0 means never expire.
         """
+        if serializer is None:
+            # Backward compatibility.
+            # TODO: deprecate pickle.
+            serializer = picklecompat
+        if not hasattr(serializer, 'loads'):
+            raise TypeError("serializer does not implement 'loads' function: %r" % serializer)
+        if not hasattr(serializer, 'dumps'):
+            raise TypeError("serializer does not implement 'dumps' function: %r" % serializer)
         self.server = server
         self.spider = spider
-        self.serializer = picklecompat
+        self.serializer = serializer
+        self.use_envelope = use_envelope
+        self.request_ttl = request_ttl
 
     def _encode_request(self, request):
         """Encode a request object"""
         obj = request_to_dict(request, self.spider)
-        return self.serializer.dumps(obj)
+        data = self.serializer.dumps(obj)
+        if self.use_envelope:
+            data = envelope.wrap(data, RequestTask.from_request(request), self.request_ttl)
+        return data
 
     def _decode_request(self, encoded_request):
-        """Decode an request previously encoded"""
-        obj = self.serializer.loads(encoded_request)
+        """Decode an request previously encoded.
+
+        Returns None if ``header_filter`` rejects it from the envelope header.
+        """
+        header, body = envelope.unwrap(encoded_request)
+        if header is not None and self.header_filter is not None and not self.header_filter(header, body):
+            return None
+        obj = self.serializer.loads(body)
         return request_from_dict(obj, self.spider)
 
     def __len__(self):
@@ -39,47 +429,645 @@ class Base(object):
         """Push a request"""
         raise NotImplementedError
 
+    def push_many(self, requests):
+        """Push several requests"""
+        raise NotImplementedError
+
     def pop(self, timeout=0):
         """Pop a request"""
         raise NotImplementedError
 
+    def pop_many(self, count):
+        """Pop up to ``count`` requests"""
+        raise NotImplementedError
+
+    def push_back(self, requests):
+        """Return popped requests to the head of the queue"""
+        raise NotImplementedError
+
+    def ack(self, request):
+        """Acknowledge a request popped in reliable mode"""
+        pass
+
     def clear(self):
         """Clear queue/stack"""
         raise NotImplementedError
 
 
 class SpiderPriorityQueue(Base):
-    """Per-spider priority queue abstraction using redis' sorted set"""
-    def __init__(self, server, spider):
-        self.keys = TASK_QUEUE_KEY['priority_queue']
-        super(SpiderPriorityQueue, self).__init__(server, spider)
+    """Per-spider priority queue abstraction using redis' sorted set
+
+    In reliable mode every popped request is moved atomically into a lease
+    owned by ``worker_id`` and is only forgotten once ``ack`` is called. A
+    blocking ``pop`` polls the atomic pop every ``POLL_INTERVAL`` seconds
+    instead of using ``BRPOP``. Leases
+    not acknowledged within ``lease_timeout`` seconds are put back at the head
+    of their priority list by ``requeue_expired``.
+
+    With ``routing`` set to ``spider`` or ``task_type`` every priority list is
+    split into namespaces, ``<priority list>:<namespace>``. Requests are pushed
+    to the namespace of their spider or ``task_type`` and only the lists of
+    ``namespaces`` are popped, so a worker never receives work it has no
+    callbacks for.
+
+    With ``fair`` every priority list is further split into one sub-queue per
+    ``task_id``, ``<priority list>:task:<task_id>``. The task_ids of non-empty
+    sub-queues are kept in a ring, ``<priority list>:tasks``, and pops take
+    ``weight`` requests (default 1, see ``set_task_weight``) from the task at
+    the end of the ring before rotating it, so a task with a huge backlog
+    cannot starve the others of the same priority. Requests written straight
+    onto a priority list, e.g. by an external dispatcher, take part in the
+    rotation as one more task with an empty task_id and are counted too.
+
+    ``len(queue)`` sums ``depths``, the lengths of all popped lists fetched
+    in one pipeline and cached for ``depth_ttl`` seconds. Local pushes drop
+    the cache, pops by other workers show up once it expires.
+
+    With ``wakeup`` every push, requeue and promotion is published on the
+    wakeup channel of ``scrapy_redis2.wakeup``.
+    """
+    def __init__(self, server, spider, serializer=None, reliable=False, worker_id=None,
+                 lease_timeout=defaults.SCHEDULER_LEASE_TIMEOUT, routing=defaults.SCHEDULER_QUEUE_ROUTING,
+                 namespaces=None, fair=defaults.SCHEDULER_QUEUE_FAIR, depth_ttl=defaults.SCHEDULER_QUEUE_DEPTH_TTL,
+                 wakeup=defaults.SCHEDULER_IDLE_BACKOFF, **kwargs):
+        if routing not in ROUTINGS:
+            raise ValueError("Unknown queue routing: %r" % routing)
+        self.routing = routing
+        self.namespaces = list(namespaces or [])
+        if routing != ROUTING_GLOBAL and not self.namespaces:
+            raise ValueError("Queue routing %r requires namespaces" % routing)
+        # 按优先级排列，同一优先级的各命名空间相邻
+        self.keys = [self._namespaced(key, namespace)
+                     for key in TASK_QUEUE_KEY['priority_queue'] for namespace in (self.namespaces or [None])]
+        super(SpiderPriorityQueue, self).__init__(server, spider, serializer, **kwargs)
+        self._pop_script = server.register_script(PRIORITY_POP_SCRIPT)
+        self._pop_many_script = server.register_script(PRIORITY_POP_MANY_SCRIPT)
+        self.fair = fair
+        self.wakeup = wakeup
+        self.depth_ttl = depth_ttl
+        # (获取时间, {key: 长度})
+        self._depths = None
+        self.weights_key = TASK_QUEUE_KEY['task_weights']
+        self._fair_push_script = server.register_script(FAIR_PUSH_SCRIPT)
+        self._fair_pop_many_script = server.register_script(FAIR_POP_MANY_SCRIPT)
+        self._fair_reliable_pop_many_script = server.register_script(FAIR_RELIABLE_POP_MANY_SCRIPT)
+
+        if reliable and (worker_id is None or worker_id == ''):
+            # 否则所有worker共用同一个租约key
+            raise ValueError("Reliable queue requires a worker_id (SCRAPY_WORKER_ID)")
+        self.reliable = reliable
+        self.worker_id = str(worker_id)
+        self.lease_timeout = lease_timeout
+        self.lease_keys = [
+            TASK_QUEUE_KEY['inflight_queue'] % self.worker_id,
+            TASK_QUEUE_KEY['inflight_data'] % self.worker_id,
+            TASK_QUEUE_KEY['inflight_workers'],
+            TASK_QUEUE_KEY['lease_seq'],
+        ]
+        self._reliable_pop_many_script = server.register_script(RELIABLE_POP_MANY_SCRIPT)
+        self._requeue_script = server.register_script(RELIABLE_REQUEUE_SCRIPT)
+
+    @classmethod
+    def from_spider(cls, server, spider, serializer=None):
+        """Returns a queue configured from the spider settings."""
+        return cls.from_settings(server, spider.settings, spider=spider, serializer=serializer)
+
+    @classmethod
+    def from_settings(cls, server, settings, spider=None, serializer=None, spider_name=None):
+        """Returns a queue configured from ``settings``.
+
+        ``spider_name`` is the namespace for ``spider`` routing when no spider
+        is given, e.g. to push seeds.
+
+        Settings
+        --------
+        SCHEDULER_SERIALIZER : str
+            Used when ``serializer`` is not given.
+        SCHEDULER_RELIABLE_QUEUE : bool (default: False)
+            Keep popped requests in a per-worker lease until acknowledged.
+        SCHEDULER_LEASE_TIMEOUT : int (default: 600)
+            Seconds before an unacknowledged request is handed out again.
+        SCRAPY_WORKER_ID : str
+            Owner of the leases, required with ``SCHEDULER_RELIABLE_QUEUE``.
+        SCHEDULER_ENVELOPE : bool (default: False)
+            Wrap pushed requests in an envelope with a cheap-to-read header.
+        SCHEDULER_REQUEST_TTL : int (default: 0)
+            Default ttl in seconds written to the envelope, 0 means never.
+        SCHEDULER_QUEUE_ROUTING : str (default: "global")
+            ``global`` shares the priority lists between all spiders,
+            ``spider`` splits them by spider name and ``task_type`` by the
+            requests' ``task_type``.
+        SCHEDULER_TASK_TYPES : list
+            Task types this worker pops with ``task_type`` routing, defaults
+            to the spider's ``task_types`` attribute.
+        SCHEDULER_QUEUE_FAIR : bool (default: False)
+            Pop round-robin across the task_ids of each priority list.
+        SCHEDULER_QUEUE_DEPTH_TTL : float (default: 1.0)
+            Seconds ``depths`` are cached for, 0 disables the cache.
+        SCHEDULER_IDLE_BACKOFF : bool (default: False)
+            Publish pushes so idle workers wake up.
+        """
+        routing = settings.get('SCHEDULER_QUEUE_ROUTING') or defaults.SCHEDULER_QUEUE_ROUTING
+        if spider_name is None and spider is not None:
+            spider_name = spider.name
+        namespaces = None
+        if routing == ROUTING_SPIDER:
+            namespaces = [spider_name] if spider_name else None
+        elif routing == ROUTING_TASK_TYPE:
+            namespaces = settings.getlist('SCHEDULER_TASK_TYPES') or list(getattr(spider, 'task_types', None) or [])
+            # 只推送不出队时(如导入种子)命名空间由请求决定
+            namespaces = namespaces or [DEFAULT_NAMESPACE]
+        if serializer is None:
+            serializer = get_serializer_from_settings(settings)
+        return cls(server, spider, serializer=serializer, routing=routing, namespaces=namespaces,
+                   fair=settings.getbool('SCHEDULER_QUEUE_FAIR', defaults.SCHEDULER_QUEUE_FAIR),
+                   depth_ttl=settings.getfloat('SCHEDULER_QUEUE_DEPTH_TTL', defaults.SCHEDULER_QUEUE_DEPTH_TTL),
+                   wakeup=settings.getbool('SCHEDULER_IDLE_BACKOFF', defaults.SCHEDULER_IDLE_BACKOFF),
+                   reliable=settings.getbool('SCHEDULER_RELIABLE_QUEUE', defaults.SCHEDULER_RELIABLE_QUEUE),
+                   worker_id=settings.get('SCRAPY_WORKER_ID'),
+                   lease_timeout=settings.getint('SCHEDULER_LEASE_TIMEOUT', defaults.SCHEDULER_LEASE_TIMEOUT),
+                   use_envelope=settings.getbool('SCHEDULER_ENVELOPE', defaults.SCHEDULER_ENVELOPE),
+                   request_ttl=settings.getint('SCHEDULER_REQUEST_TTL', defaults.SCHEDULER_REQUEST_TTL))
 
     def __len__(self):
-        r = self.server
-        tol = 0
-        for i in range(len(self.keys)):
-            tol = tol + r.llen(self.keys[i])
-        return tol
+        return sum(self.depths().values())
+
+    def depths(self):
+        """Returns ``{key: length}`` of the popped lists (and fair sub-queues in fair mode).
+
+        Fetched in one pipeline and cached for ``depth_ttl`` seconds.
+        """
+        now = time.time()
+        cached = self._depths
+        if cached is not None and now - cached[0] < self.depth_ttl:
+            return cached[1]
+        depths = self._fetch_depths()
+        self._depths = (now, depths)
+        return depths
+
+    def _fetch_depths(self):
+        keys = self.keys + self._sub_queues() if self.fair else self.keys
+        pipe = self.server.pipeline(transaction=False)
+        for key in keys:
+            pipe.llen(key)
+        return OrderedDict(zip(keys, pipe.execute()))
 
     def clear(self):
         r = self.server
+        if self.fair:
+            for key in self._sub_queues():
+                r.delete(key)
+            for key in self.keys:
+                r.delete(key + ':tasks', key + ':credit')
         for key in self.keys:
             r.delete(key)
+        self._depths = None
+
+    def _sub_queues(self):
+        """Returns the per task_id sub-queues of the popped priority lists"""
+        pipe = self.server.pipeline(transaction=False)
+        for key in self.keys:
+            pipe.lrange(key + ':tasks', 0, -1)
+        keys = []
+        for key, task_ids in zip(self.keys, pipe.execute()):
+            for task_id in sorted(set(task_ids)):
+                if isinstance(task_id, bytes):
+                    task_id = task_id.decode()
+                if not task_id:
+                    # 优先级队列本身
+                    continue
+                keys.append('%s:task:%s' % (key, task_id))
+        return keys
+
+    def set_task_weight(self, task_id, weight):
+        """Let a task take ``weight`` requests per turn in fair mode, None resets it to 1"""
+        if weight is None or int(weight) <= 1:
+            self.server.hdel(self.weights_key, task_id)
+        else:
+            self.server.hset(self.weights_key, task_id, int(weight))
+
+    @staticmethod
+    def _namespaced(key, namespace):
+        if namespace is None:
+            return key
+        return '%s:%s' % (key, namespace)
+
+    def _namespace(self, request):
+        """Returns the namespace a request is pushed to"""
+        if self.routing == ROUTING_TASK_TYPE:
+            task_type = RequestTask.from_request(request).task_type
+            return str(task_type) if task_type is not None else DEFAULT_NAMESPACE
+        if self.routing == ROUTING_SPIDER:
+            return self.namespaces[0]
+        return None
+
+    def _priority_key(self, request):
+        """Returns the priority list a request belongs to"""
+        task = RequestTask.from_request(request)
+        keys = TASK_QUEUE_KEY['priority_queue']
+        try:
+            index = int(task.priority)
+        except (TypeError, ValueError):
+            index = len(keys) - 1
+        key = keys[min(max(index, 0), len(keys) - 1)]
+        return self._namespaced(key, self._namespace(request))
+
+    def _group_key(self, request):
+        """Returns the priority list, in fair mode ``(priority list, task_id)``"""
+        key = self._priority_key(request)
+        if not self.fair:
+            return key
+        task_id = RequestTask.from_request(request).task_id
+        # 空串保留给外部直接写入优先级队列的数据
+        return key, str(task_id) if task_id is not None and task_id != '' else DEFAULT_NAMESPACE
+
+    def _destination(self, request):
+        """Returns ``(key, task_id, score)`` a request is pushed to, used by ``DelayQueue``"""
+        key = self._group_key(request)
+        if isinstance(key, tuple):
+            return key[0], key[1], None
+        return key, None, None
 
     def push(self, request):
-        pass
+        self.push_many([request])
+
+    def push_many(self, requests):
+        """Push requests onto their priority lists with one pipelined LPUSH per list.
+
+        ``RequestTask.priority`` (0-4) selects the list, out of range values are
+        clamped to the nearest one.
+        """
+        self.push_encoded(self.encode_many(requests))
+
+    def encode_many(self, requests):
+        """Stamp ``enqueue_time`` and encode requests, grouped by priority list.
+
+        In fair mode the groups are keyed by ``(priority list, task_id)``.
+        """
+        groups = OrderedDict()
+        now = time.time()
+        for request in requests:
+            RequestTask.from_request(request).enqueue_time = now
+            groups.setdefault(self._group_key(request), []).append(self._encode_request(request))
+        return groups
+
+    def push_encoded(self, groups, head=False):
+        """LPUSH payloads returned by ``encode_many`` in a single pipeline.
+
+        With ``head`` they are RPUSHed, i.e. popped next.
+        """
+        if not groups:
+            return
+        self._depths = None
+        pipe = self.server.pipeline(transaction=False)
+        for key, datas in groups.items():
+            if isinstance(key, tuple):
+                key, task_id = key
+                self._fair_push_script(keys=[key], args=[task_id, 'tail' if head else 'head'] + list(datas),
+                                       client=pipe)
+            elif head:
+                pipe.rpush(key, *datas)
+            else:
+                pipe.lpush(key, *datas)
+        if self.wakeup:
+            publish_wakeup(pipe)
+        pipe.execute()
+
+    def _decode_leased(self, token, data):
+        token = token.decode() if isinstance(token, bytes) else str(token)
+        request = self._decode_request(data)
+        if request is None:
+            # 被header_filter丢弃的请求不再需要租约
+            self.ack_tokens([token])
+        else:
+            request.meta[LEASE_META_KEY] = token
+        return request
 
     def pop(self, timeout=0):
         r = self.server
+        if self.fair or self.reliable:
+            # 公平模式的子队列不固定，无法BRPOP; 可靠模式下出队与记录租约须在同一脚本中原子完成，
+            # 而redis没有多个来源的阻塞移动(BLMOVE只有一个来源)，都改为轮询
+            return self._poll(timeout)
         if timeout > 0:
             data = r.brpop(self.keys, timeout)
             if isinstance(data, tuple):
                 data = data[1]
         else:
-            for i in range(len(self.keys)):
-                data = r.rpop(self.keys[i])
-                if data is not None:
-                    break
+            data = self._pop_script(keys=self.keys)
         if data:
             return self._decode_request(data)
 
+    def _poll(self, timeout):
+        """Pop one request, retrying every ``POLL_INTERVAL`` for up to ``timeout`` seconds"""
+        deadline = time.time() + timeout
+        while True:
+            requests = self.pop_many(1)
+            remaining = deadline - time.time()
+            if requests or remaining <= 0:
+                return requests[0] if requests else None
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+    def pop_many(self, count):
+        """Pop up to ``count`` requests in one round trip, highest priority first"""
+        if count <= 0:
+            return []
+        if self.reliable:
+            if self.fair:
+                datas = self._fair_reliable_pop_many_script(
+                    keys=self.lease_keys + [self.weights_key] + self.keys,
+                    args=[count, time.time() + self.lease_timeout, self.worker_id])
+            else:
+                datas = self._reliable_pop_many_script(keys=self.lease_keys + self.keys,
+                                                       args=[count, time.time() + self.lease_timeout, self.worker_id])
+            requests = [self._decode_leased(datas[i], datas[i + 1]) for i in range(0, len(datas), 2)]
+        elif self.fair:
+            datas = self._fair_pop_many_script(keys=[self.weights_key] + self.keys, args=[count])
+            requests = [self._decode_request(data) for data in datas]
+        else:
+            datas = self._pop_many_script(keys=self.keys, args=[count])
+            requests = [self._decode_request(data) for data in datas]
+        return [request for request in requests if request is not None]
+
+    def push_back(self, requests):
+        """Return popped requests to the head of their priority lists.
+
+        ``requests`` is in pop order; the first one will be popped first again.
+        """
+        if not requests:
+            return
+        if self.reliable:
+            # 有租约的直接用租约中保存的原始数据放回
+            leased = [request for request in requests if LEASE_META_KEY in request.meta]
+            requests = [request for request in requests if LEASE_META_KEY not in request.meta]
+            tokens = [request.meta.pop(LEASE_META_KEY) for request in leased]
+            if tokens:
+                self._requeue_script(keys=self.lease_keys[:3], args=[0, 0, self.worker_id] + tokens[::-1])
+            if not requests:
+                return
+        groups = OrderedDict()
+        for request in reversed(requests):
+            groups.setdefault(self._group_key(request), []).append(self._encode_request(request))
+        self.push_encoded(groups, head=True)
+
+    def ack(self, request):
+        """Release the lease of a request that was fully handled"""
+        token = request.meta.pop(LEASE_META_KEY, None)
+        if self.reliable and token is not None:
+            self.ack_tokens([token])
+
+    def ack_tokens(self, tokens, pipe=None):
+        """Release leases by token. Commands are only queued when ``pipe`` is given."""
+        if not tokens:
+            return
+        execute = pipe is None
+        if execute:
+            pipe = self.server.pipeline()
+        pipe.zrem(self.lease_keys[0], *tokens)
+        for token in tokens:
+            pipe.hdel(self.lease_keys[1], token, token + ':q', token + ':t', token + ':s', token + ':m')
+        if execute:
+            pipe.execute()
+
+    def requeue_expired(self, limit=1000):
+        """Put expired leases of every worker back on their priority lists.
+
+        Returns the number of requests requeued.
+        """
+        count = 0
+        now = time.time()
+        for worker_id in self.server.smembers(TASK_QUEUE_KEY['inflight_workers']):
+            if isinstance(worker_id, bytes):
+                worker_id = worker_id.decode()
+            keys = [TASK_QUEUE_KEY['inflight_queue'] % worker_id,
+                    TASK_QUEUE_KEY['inflight_data'] % worker_id,
+                    TASK_QUEUE_KEY['inflight_workers']]
+            count += self._requeue_script(keys=keys, args=[now, limit, worker_id])
+        if count and self.wakeup:
+            publish_wakeup(self.server)
+        return count
+
+
+class SortedPriorityQueue(SpiderPriorityQueue):
+    """Per-spider priority queue backed by one redis sorted set
+
+    Requests are ordered by their level, ``RequestTask.priority`` (default 4,
+    any integer, lower first) minus Scrapy's ``request.priority``, and FIFO
+    within the same level. A batch of the top ``count`` requests is popped
+    with a single ``ZPOPMIN`` and the length is a single ``ZCARD``. ``pop``
+    with a timeout blocks on ``BZPOPMIN`` while the sorted sets are empty,
+    in reliable mode it polls like ``SpiderPriorityQueue``.
+
+    With ``aging`` (seconds) the score becomes
+    ``level * aging + enqueue_time`` in milliseconds, so a request that
+    waited ``aging`` seconds longer than another one overtakes it by one
+    level and low priorities cannot starve.
+
+    Routing namespaces and reliable leases work as in ``SpiderPriorityQueue``,
+    the fair mode is not supported.
+    """
+    def __init__(self, server, spider, serializer=None, aging=defaults.SCHEDULER_QUEUE_AGING, **kwargs):
+        super(SortedPriorityQueue, self).__init__(server, spider, serializer, **kwargs)
+        if self.fair:
+            raise ValueError("SortedPriorityQueue does not support the fair mode")
+        self.aging = aging
+        self.keys = [self._namespaced(TASK_QUEUE_KEY['sorted_queue'], namespace)
+                     for namespace in (self.namespaces or [None])]
+        self.seq_key = TASK_QUEUE_KEY['sorted_seq']
+        self.head_seq_key = TASK_QUEUE_KEY['sorted_head_seq']
+        self._sorted_push_script = server.register_script(SORTED_PUSH_SCRIPT)
+        self._sorted_pop_many_script = server.register_script(SORTED_POP_MANY_SCRIPT)
+        self._sorted_reliable_pop_many_script = server.register_script(SORTED_RELIABLE_POP_MANY_SCRIPT)
+
+    @classmethod
+    def from_settings(cls, server, settings, **kwargs):
+        """Returns a queue configured from ``settings``.
+
+        Settings
+        --------
+        SCHEDULER_QUEUE_AGING : float (default: 0)
+            Seconds of waiting worth one priority level, 0 disables aging.
+
+        See ``SpiderPriorityQueue.from_settings`` for the others.
+        """
+        queue = super(SortedPriorityQueue, cls).from_settings(server, settings, **kwargs)
+        queue.aging = settings.getfloat('SCHEDULER_QUEUE_AGING', defaults.SCHEDULER_QUEUE_AGING)
+        return queue
+
+    def _fetch_depths(self):
+        pipe = self.server.pipeline(transaction=False)
+        for key in self.keys:
+            pipe.zcard(key)
+        return OrderedDict(zip(self.keys, pipe.execute()))
+
+    def clear(self):
+        self.server.delete(*self.keys)
+        self._depths = None
+
+    def _score(self, request):
+        task = RequestTask.from_request(request)
+        try:
+            level = int(task.priority)
+        except (TypeError, ValueError):
+            level = 4
+        level -= request.priority
+        if not self.aging:
+            return level
+        enqueue_time = task.enqueue_time or time.time()
+        return int(level * self.aging * 1000 + enqueue_time * 1000)
+
+    def _group_key(self, request):
+        """Returns ``(sorted set, score)``"""
+        return self._namespaced(TASK_QUEUE_KEY['sorted_queue'], self._namespace(request)), self._score(request)
+
+    def _destination(self, request):
+        key, score = self._group_key(request)
+        return key, None, score
+
+    def push_encoded(self, groups, head=False):
+        """ZADD payloads returned by ``encode_many`` with one script call per sorted set.
+
+        With ``head`` they go before the requests of the same score.
+        """
+        if not groups:
+            return
+        self._depths = None
+        args = OrderedDict()
+        for (key, score), datas in groups.items():
+            items = args.setdefault(key, [])
+            for data in datas:
+                items.extend([score, data])
+        pipe = self.server.pipeline(transaction=False)
+        for key, items in args.items():
+            self._sorted_push_script(keys=[key, self.seq_key, self.head_seq_key], args=['head' if head else 'tail'] + items,
+                                     client=pipe)
+        if self.wakeup:
+            publish_wakeup(pipe)
+        pipe.execute()
+
+    def pop(self, timeout=0):
+        if self.reliable:
+            # 出队与记录租约须原子完成，见SpiderPriorityQueue.pop
+            return self._poll(timeout)
+        requests = self.pop_many(1)
+        if requests or timeout <= 0:
+            return requests[0] if requests else None
+        # 所有有序集合都为空，阻塞等待第一条入队的数据
+        data = self.server.bzpopmin(self.keys, timeout)
+        if data:
+            return self._decode_request(data[1][SORTED_SEQ_WIDTH:])
+
+    def pop_many(self, count):
+        """Pop up to ``count`` requests with the lowest scores in one round trip"""
+        if count <= 0:
+            return []
+        if self.reliable:
+            datas = self._sorted_reliable_pop_many_script(
+                keys=self.lease_keys + self.keys,
+                args=[count, time.time() + self.lease_timeout, self.worker_id])
+            requests = [self._decode_leased(datas[i], datas[i + 1]) for i in range(0, len(datas), 2)]
+        else:
+            datas = self._sorted_pop_many_script(keys=self.keys, args=[count])
+            requests = [self._decode_request(data) for data in datas]
+        return [request for request in requests if request is not None]
+
+
+class DelayQueue(object):
+    """Retried requests waiting in a redis sorted set until they are due
+
+    Every request gets a due time from an exponential backoff on its
+    ``retry_times``: ``delay * factor ** (retry_times - 1)`` seconds, capped
+    at ``max_delay`` and jittered down to half of it so retries of a failing
+    host spread out. ``backoff`` overrides ``delay``, ``factor`` and
+    ``max_delay`` per ``task_type``.
+
+    ``promote`` moves due requests in batches onto the list, fair sub-queue
+    or sorted set ``queue`` would have pushed them to, in a single script
+    call, so any worker can run it.
+    """
+
+    def __init__(self, queue, delay=defaults.SCHEDULER_RETRY_DELAY, factor=defaults.SCHEDULER_RETRY_DELAY_FACTOR,
+                 max_delay=defaults.SCHEDULER_RETRY_DELAY_MAX, backoff=None):
+        """
+        Parameters
+        ----------
+        queue : SpiderPriorityQueue
+            Encodes requests and selects where they are promoted to.
+        delay, factor, max_delay : float
+            Default backoff in seconds.
+        backoff : dict, optional
+            ``{task_type: {'delay': .., 'factor': .., 'max_delay': ..}}``.
+        """
+        self.queue = queue
+        self.server = queue.server
+        self.delay = delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.backoff = dict(backoff or {})
+        self.keys = [TASK_QUEUE_KEY['delay_queue'], TASK_QUEUE_KEY['delay_data']]
+        self._push_script = self.server.register_script(DELAY_PUSH_SCRIPT)
+        self._promote_script = self.server.register_script(DELAY_PROMOTE_SCRIPT)
+
+    @classmethod
+    def from_settings(cls, queue, settings):
+        """Returns a delay queue for ``queue``, None if ``SCHEDULER_RETRY_DELAY`` is 0.
+
+        Settings
+        --------
+        SCHEDULER_RETRY_DELAY : float (default: 0)
+            Seconds before the first retry.
+        SCHEDULER_RETRY_DELAY_FACTOR : float (default: 2)
+            Backoff multiplier per further retry.
+        SCHEDULER_RETRY_DELAY_MAX : float (default: 600)
+            Upper bound of the delay.
+        SCHEDULER_RETRY_BACKOFF : dict
+            The three values above per ``task_type``.
+        """
+        delay = settings.getfloat('SCHEDULER_RETRY_DELAY', defaults.SCHEDULER_RETRY_DELAY)
+        if delay <= 0:
+            return None
+        return cls(queue, delay=delay,
+                   factor=settings.getfloat('SCHEDULER_RETRY_DELAY_FACTOR', defaults.SCHEDULER_RETRY_DELAY_FACTOR),
+                   max_delay=settings.getfloat('SCHEDULER_RETRY_DELAY_MAX', defaults.SCHEDULER_RETRY_DELAY_MAX),
+                   backoff=settings.getdict('SCHEDULER_RETRY_BACKOFF'))
+
+    def __len__(self):
+        return self.server.zcard(self.keys[0])
+
+    def backoff_delay(self, request):
+        """Returns the delay in seconds before ``request`` is retried"""
+        task_type = RequestTask.from_request(request).task_type
+        backoff = self.backoff.get(task_type) or {}
+        delay = backoff.get('delay', self.delay)
+        factor = backoff.get('factor', self.factor)
+        max_delay = backoff.get('max_delay', self.max_delay)
+        retries = max(int(request.meta.get('retry_times') or 1), 1)
+        delay = min(delay * factor ** (retries - 1), max_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+    def encode_many(self, requests):
+        """Returns the arguments of the push script, encoded in the calling thread"""
+        args = []
+        now = time.time()
+        for request in requests:
+            key, task_id, score = self.queue._destination(request)
+            args.extend([now + self.backoff_delay(request), key, task_id or '',
+                         '' if score is None else score, self.queue._encode_request(request)])
+        return args
+
+    def push_encoded(self, args):
+        if args:
+            self._push_script(keys=self.keys + [TASK_QUEUE_KEY['delay_seq']], args=args)
+
+    def push(self, request):
+        self.push_encoded(self.encode_many([request]))
+
+    def promote(self, limit=defaults.SCHEDULER_RETRY_PROMOTE_BATCH):
+        """Move up to ``limit`` due requests onto their queues, returns how many"""
+        count = self._promote_script(keys=self.keys + [TASK_QUEUE_KEY['sorted_seq']], args=[time.time(), limit])
+        if count and self.queue.wakeup:
+            publish_wakeup(self.server)
+        return count
+
+    def clear(self):
+        self.server.delete(*self.keys)
@@ -34,7 +34,9 @@ request中 meta 中scrapy_redis格式：
             # 进入队列时间
             'enqueue_time': None,
             # 自定义参数
-            'params': None
+            'params': None,
+            # 有效期(秒)，超过 create_time + ttl 的请求出队时丢弃
+            'ttl': None
     }
 }
 '''
@@ -87,6 +89,14 @@ class RequestTask(object):
     def params(self):
         return self._crawler_scheduler.get('params', None)
 
+    @property
+    def ttl(self):
+        return self._crawler_scheduler.get('ttl', None)
+
+    @ttl.setter
+    def ttl(self, val):
+        self._crawler_scheduler['ttl'] = val
+
     @property
     def create_time(self):
         return self._crawler_scheduler.get('create_time', None)
@@ -149,6 +159,22 @@ class RequestTask(object):
     def __str__(self):
         return json.dumps(self._crawler_scheduler, ensure_ascii=False)
 
+    def state_event(self, fingerprint, request_state=None):
+        """Returns the record reported for a state change instead of the whole request."""
+        return {
+            'fingerprint': fingerprint,
+            'task_id': self.task_id,
+            'task_no': self.task_no,
+            'task_type': self.task_type,
+            'depth': self.depth,
+            'request_state': self.request_state if request_state is None else request_state,
+            'worker_id': self.worker_id,
+            'create_time': self.create_time,
+            'enqueue_time': self.enqueue_time,
+            # 状态上报时间
+            'finish_time': round(time.time(), 3),
+        }
+
     @staticmethod
     def get_errback_from_request(request):
         return request.meta['crawler_scheduler'].get('errback', None)
@@ -177,7 +203,7 @@ class RequestTask(object):
         return obj
 
     @classmethod
-    def from_create(cls, task_id, task_no=None, priority=4, depth=None, task_type=None, params=None):
+    def from_create(cls, task_id, task_no=None, priority=4, depth=None, task_type=None, params=None, ttl=None):
         crawler_scheduler = {
             # 任务ID, 唯一
             'task_id': task_id,
@@ -202,7 +228,9 @@ class RequestTask(object):
             # 进入队列时间
             'enqueue_time': None,
             # 自定义参数
-            'params': params
+            'params': params,
+            # 有效期(秒)
+            'ttl': ttl
         }
         return cls(crawler_scheduler)
 
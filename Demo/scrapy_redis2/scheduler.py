@@ -1,10 +1,17 @@
-import importlib
-import six
+import logging
+from collections import deque
 
-from . import connection, defaults, request_task
+from twisted.internet import defer, task
+
+from . import connection, defaults, request_task, threadio
 from .schedulertask import processed_task_queue
 from .dupefilter import RFPDupeFilter
-from .queue import SpiderPriorityQueue
+from .queue import LEASE_META_KEY, DelayQueue
+from .utils import get_queue_class_from_settings, get_serializer_from_settings
+from .wakeup import IdleBackoff
+
+
+logger = logging.getLogger(__name__)
 
 
 # TODO: add SCRAPY_JOB support.
@@ -14,13 +21,75 @@ class Scheduler(object):
     Settings
     --------
     SCHEDULER_SERIALIZER : str
-        Scheduler serializer.
+        Scheduler serializer, e.g. ``scrapy_redis2.compactcompat``.
+    SCHEDULER_COMPRESS_THRESHOLD : int (default: 1024)
+        Payload size above which ``compactcompat`` compresses requests.
     SCHEDULER_IDLE_BEFORE_CLOSE : int (default: 0)
         How many seconds to wait before closing if no message is received.
+    SCHEDULER_IDLE_BACKOFF : bool (default: False)
+        Instead of blocking pops, poll empty queues less and less often and
+        wake up as soon as a push is published on the wakeup channel.
+        External dispatchers should publish there too.
+    SCHEDULER_IDLE_MIN_DELAY : float (default: 1)
+    SCHEDULER_IDLE_MAX_DELAY : float (default: 30)
+        Bounds of the delay between polls while idle.
+    SCHEDULER_PREFETCH_SIZE : int (default: CONCURRENT_REQUESTS)
+        How many decoded requests to keep ready locally. 0 disables prefetch.
+    SCHEDULER_PREFETCH_LOW_WATER : int (default: SCHEDULER_PREFETCH_SIZE / 2)
+        Refill the prefetch buffer in one batch when it drops to this size.
+    SCHEDULER_ASYNC_IO : bool (default: True)
+        Pop requests in a dedicated thread so a blocking pop never stalls the
+        reactor. ``next_request`` then only reads the prefetch buffer.
+    SCHEDULER_DIRECT_ENQUEUE : bool (default: False)
+        Push new requests straight onto the shared priority queues instead of
+        sending them to the dispatcher through ``processed_queue``.
+    SCHEDULER_RELIABLE_QUEUE : bool (default: False)
+        Lease popped requests to ``SCRAPY_WORKER_ID`` until they are acknowledged.
+    SCHEDULER_LEASE_REAP_INTERVAL : int (default: 60)
+        How often expired leases of all workers are put back on the queues.
+    SCHEDULER_ENVELOPE : bool (default: False)
+        Wrap pushed requests in an envelope. Enveloped requests that expired
+        are dropped without decoding their body. Those whose callback is
+        unknown are reported as RETRIED from their decoded dict, without
+        building a Request.
+    SCHEDULER_REQUEST_TTL : int (default: 0)
+        Default request ttl written to the envelope, 0 means never expire.
+    SCHEDULER_QUEUE_ROUTING : str (default: "global")
+        Split the priority lists by ``spider`` name or ``task_type`` so a
+        worker only pops requests it can handle.
+    SCHEDULER_TASK_TYPES : list
+        Task types popped with ``task_type`` routing, defaults to the
+        spider's ``task_types`` attribute.
+    SCHEDULER_QUEUE_FAIR : bool (default: False)
+        Give every task_id its own sub-queue per priority and pop them
+        round-robin, weighted by ``SpiderPriorityQueue.set_task_weight``.
+    SCHEDULER_QUEUE_CLASS : str (default: "scrapy_redis2.queue.SpiderPriorityQueue")
+        ``scrapy_redis2.queue.SortedPriorityQueue`` keeps requests in a
+        sorted set with arbitrary integer priorities.
+    SCHEDULER_QUEUE_DEPTH_TTL : float (default: 1.0)
+        Seconds the pipelined queue lengths behind ``has_pending_requests``
+        are cached for. The total is kept in the ``scheduler/queue_depth/redis``
+        stat.
+    SCHEDULER_QUEUE_AGING : float (default: 0)
+        Seconds of waiting a ``SortedPriorityQueue`` request is worth one
+        priority level, 0 disables aging.
+    SCHEDULER_RETRY_DELAY : float (default: 0)
+        Keep retried requests in a ``DelayQueue`` for an exponential backoff
+        starting at this many seconds instead of handing them to the
+        dispatcher at once. 0 disables it.
+    SCHEDULER_RETRY_DELAY_FACTOR : float (default: 2)
+    SCHEDULER_RETRY_DELAY_MAX : float (default: 600)
+    SCHEDULER_RETRY_BACKOFF : dict
+        ``{task_type: {'delay': .., 'factor': .., 'max_delay': ..}}``
+    SCHEDULER_RETRY_PROMOTE_INTERVAL : float (default: 1)
+        How often due retries are moved back onto the queues.
+    SCHEDULER_RETRY_PROMOTE_BATCH : int (default: 1000)
+        Retries moved per promotion.
 
     """
 
-    def __init__(self, server, idle_before_close=defaults.SCHEDULER_IDLE_BEFORE_CLOSE, serializer=None):
+    def __init__(self, server, idle_before_close=defaults.SCHEDULER_IDLE_BEFORE_CLOSE, serializer=None,
+                 prefetch_size=0, prefetch_low_water=None, io=None, direct_enqueue=False):
         """Initialize scheduler.
 
         Parameters
@@ -29,43 +98,73 @@ class Scheduler(object):
             The redis server instance.
         idle_before_close : int
             Timeout before giving up.
+        prefetch_size : int
+            Size of the local prefetch buffer.
+        prefetch_low_water : int
+            Buffer size below which the buffer is refilled.
+        io : threadio.RedisIO, optional
+            Runs redis calls off the reactor thread when given.
+        direct_enqueue : bool
+            Push new requests to the priority queues, bypassing the dispatcher.
         """
         if idle_before_close < 0:
             raise TypeError("idle_before_close cannot be negative")
+        if prefetch_size < 0:
+            raise TypeError("prefetch_size cannot be negative")
+        if prefetch_low_water is None:
+            prefetch_low_water = prefetch_size // 2
 
         self.server = server
         self.serializer = serializer
         self.idle_before_close = idle_before_close
+        self.prefetch_size = prefetch_size
+        self.prefetch_low_water = min(prefetch_low_water, prefetch_size)
+        self.prefetched = deque()
+        self.io = io
+        self.direct_enqueue = direct_enqueue
+        self.lease_reap_interval = defaults.SCHEDULER_LEASE_REAP_INTERVAL
+        self.promote_interval = defaults.SCHEDULER_RETRY_PROMOTE_INTERVAL
+        self.promote_batch = defaults.SCHEDULER_RETRY_PROMOTE_BATCH
+        self.delay_queue = None
+        self.idle = None
         self.stats = None
+        self._reaper = None
+        self._promoter = None
+        self._fetching = None
+        self._closing = False
 
     def __len__(self):
-        return len(self.queue)
+        depth = len(self.queue)
+        if self.stats:
+            self.stats.set_value('scheduler/queue_depth/redis', depth, spider=self.spider)
+        return depth + len(self.prefetched)
 
     @classmethod
     def from_settings(cls, settings):
         kwargs = {
             'idle_before_close': settings.getint('SCHEDULER_IDLE_BEFORE_CLOSE', defaults.SCHEDULER_IDLE_BEFORE_CLOSE),
+            'prefetch_size': settings.getint('SCHEDULER_PREFETCH_SIZE', settings.getint('CONCURRENT_REQUESTS')),
+            'direct_enqueue': settings.getbool('SCHEDULER_DIRECT_ENQUEUE', defaults.SCHEDULER_DIRECT_ENQUEUE),
         }
 
-        # If these values are missing, it means we want to use the defaults.
-        optional = {
-            # TODO: Use custom prefixes for this settings to note that are
-            'serializer': 'SCHEDULER_SERIALIZER',
-        }
-        for name, setting_name in optional.items():
-            val = settings.get(setting_name)
-            if val:
-                kwargs[name] = val
-
-        # Support serializer as a path to a module.
-        if isinstance(kwargs.get('serializer'), six.string_types):
-            kwargs['serializer'] = importlib.import_module(kwargs['serializer'])
+        kwargs['serializer'] = get_serializer_from_settings(settings)
+        if settings.get('SCHEDULER_PREFETCH_LOW_WATER') is not None:
+            kwargs['prefetch_low_water'] = settings.getint('SCHEDULER_PREFETCH_LOW_WATER')
+        if settings.getbool('SCHEDULER_ASYNC_IO', defaults.SCHEDULER_ASYNC_IO):
+            kwargs['io'] = threadio.get_redis_io()
 
         server = connection.from_settings(settings)
         # Ensure the connection is working.
         server.ping()
 
-        return cls(server=server, **kwargs)
+        instance = cls(server=server, **kwargs)
+        instance.lease_reap_interval = settings.getint('SCHEDULER_LEASE_REAP_INTERVAL',
+                                                       defaults.SCHEDULER_LEASE_REAP_INTERVAL)
+        instance.promote_interval = settings.getfloat('SCHEDULER_RETRY_PROMOTE_INTERVAL',
+                                                      defaults.SCHEDULER_RETRY_PROMOTE_INTERVAL)
+        instance.promote_batch = settings.getint('SCHEDULER_RETRY_PROMOTE_BATCH',
+                                                 defaults.SCHEDULER_RETRY_PROMOTE_BATCH)
+        return instance
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -77,42 +176,267 @@ class Scheduler(object):
     def open(self, spider):
 
         self.spider = spider
-        self.queue = SpiderPriorityQueue(server=self.server, spider=spider)
+        queue_cls = get_queue_class_from_settings(spider.settings)
+        self.queue = queue_cls.from_spider(self.server, spider, serializer=self.serializer)
+        self.queue.header_filter = self._accept_header
+        if self.queue.reliable and self.lease_reap_interval > 0:
+            self._reaper = task.LoopingCall(self._reap_leases)
+            self._reaper.start(self.lease_reap_interval, now=False)
+        self.delay_queue = DelayQueue.from_settings(self.queue, spider.settings)
+        self.idle = IdleBackoff.from_settings(self.server, spider.settings)
+        if self.idle is not None:
+            self.idle.start()
+        if self.delay_queue is not None and self.promote_interval > 0:
+            self._promoter = task.LoopingCall(self._promote_delayed)
+            self._promoter.start(self.promote_interval, now=False)
 
         # processed_queue 队列用于接收未处理request，已处理request
-        self.processed_queue = processed_task_queue(self.server, spider)
-        self.df = RFPDupeFilter(debug=spider.settings.getbool('DUPEFILTER_DEBUG'))
+        self.processed_queue = getattr(spider, 'state_writer', None)
+        if self.processed_queue is None:
+            self.processed_queue = processed_task_queue(self.server, spider, io=self.io, serializer=self.serializer)
+        # 与spider共用，本地指纹缓存只需一份
+        self.df = getattr(spider, 'dupefilter', None)
+        if self.df is None:
+            self.df = RFPDupeFilter.from_spider(self.server, spider)
 
         self.work_id = spider.settings.get('SCRAPY_WORKER_ID')
 
         # notice if there are requests already in the queue to resume the crawl
-        if len(self.queue):
-            spider.log("Resuming crawl (%d requests scheduled)" % len(self.queue))
+        depth = len(self.queue)
+        if depth:
+            spider.log("Resuming crawl (%d requests scheduled)" % depth)
 
     def close(self, reason):
-        pass
+        self._closing = True
+        self._record_pool_metrics()
+        if self._reaper is not None and self._reaper.running:
+            self._reaper.stop()
+        if self._promoter is not None and self._promoter.running:
+            self._promoter.stop()
+        if self.idle is not None:
+            self.idle.stop()
+        if self._fetching is not None:
+            # 等待线程中的pop结束，再把结果一起放回队列
+            d = defer.Deferred()
+            self._fetching.addBoth(lambda _: d.callback(None))
+            d.addCallback(lambda _: self._push_back_prefetched())
+            return d
+        self._push_back_prefetched()
+
+    def _record_pool_metrics(self):
+        metrics = getattr(self.server.connection_pool, 'metrics', None)
+        if metrics is None or not self.stats:
+            return
+        for name, value in metrics().items():
+            self.stats.set_value('redis/pool/%s' % name, value, spider=self.spider)
+
+    def _push_back_prefetched(self):
+        # 未消费的预取request放回队列头部
+        if self.prefetched:
+            self.queue.push_back(list(self.prefetched))
+            self.prefetched.clear()
 
     def flush(self):
         self.df.clear()
         self.queue.clear()
+        self.prefetched.clear()
 
     def enqueue_request(self, request):
         if not request.dont_filter and self.df.request_seen(request):
             self.df.log(request, self.spider)
             return False
+        # 已去重，再次弹出、经engine.crawl回到调度器时不再检查
+        request.dont_filter = True
         if self.stats:
             self.stats.inc_value('scheduler/enqueued/redis', spider=self.spider)
+        # 重试、重定向的request复制了原请求的租约token，编码前去掉，推送后释放原租约
+        token = request.meta.pop(LEASE_META_KEY, None)
         if 'retry_times' in request.meta:
             # request.meta['crawler_scheduler']['request_state'] = task_defined.TASK_REQUEST_STATE_CODE_RETRIED
             req_task = request_task.RequestTask.from_request(request)
             req_task.request_state = request_task.TASK_REQUEST_STATE_CODE_RETRIED
+            if self.delay_queue is not None:
+                # 延迟到期后由_promote_delayed放回优先级队列，不再经过调度器
+                self._push_delayed(request)
+                self.spider.ack_lease(token)
+                if self.stats:
+                    self.stats.inc_value('scheduler/delayed/redis', spider=self.spider)
+                self.spider.logger.info("Scheduler.enqueue_request -->DelayQueue: " + request.url + "|" +
+                                        str(request.meta))
+                return True
+        elif self.direct_enqueue:
+            self._push_direct(request)
+            self.spider.ack_lease(token)
+            self.spider.logger.info("Scheduler.enqueue_request -->SpiderPriorityQueue: " + request.url + "|" +
+                                    str(request.meta))
+            return True
         self.processed_queue.push(request)
+        self.spider.ack_lease(token)
         self.spider.logger.info("Scheduler.enqueue_request -->processed_queue: " + request.url + "|" + str(request.meta))
         return True
 
+    def _push_direct(self, request):
+        if self.io is None:
+            self.queue.push(request)
+        else:
+            # 在reactor线程中编码，io线程只负责写redis
+            d = self.io.write(self.queue.push_encoded, self.queue.encode_many([request]))
+            d.addErrback(self._push_failed, request)
+
+    def _push_delayed(self, request):
+        if self.io is None:
+            self.delay_queue.push(request)
+        else:
+            d = self.io.write(self.delay_queue.push_encoded, self.delay_queue.encode_many([request]))
+            d.addErrback(self._push_failed, request)
+
+    def _push_failed(self, failure, request):
+        logger.error("Scheduler push to redis failed: %s|%s", request.url, failure.getErrorMessage(),
+                     extra={'spider': self.spider})
+
+    def _accept_header(self, header, body):
+        """Decides from the envelope header whether a popped request is kept.
+
+        Expired requests are dropped without decoding the body. Requests with
+        an unknown callback go back to the dispatcher marked RETRIED, which
+        still costs one ``loads`` and ``dumps`` of the body, since
+        ``processed_queue`` carries encoded request dicts; no ``Request`` is
+        built. May run in the redis io thread.
+        """
+        if header.expired():
+            if self.stats:
+                self.stats.inc_value('scheduler/expired/redis', spider=self.spider)
+            logger.info("Scheduler dropped expired request: task_id=%s|task_type=%s|create_time=%s|ttl=%s",
+                        header.task_id, header.task_type, header.create_time, header.ttl,
+                        extra={'spider': self.spider})
+            return False
+        if header.callback is not None and self.spider._get_callback(header.callback) is None:
+            # 与check_request_callback一致，标记为RETRIED交给调度器，但不构造Request;
+            # processed_queue的格式是编码后的request dict，修改状态需要解码body
+            obj = self.queue.serializer.loads(body)
+            request_task.RequestTask.from_request(obj).request_state = request_task.TASK_REQUEST_STATE_CODE_RETRIED
+            self.processed_queue.push_dict(obj)
+            if self.stats:
+                self.stats.inc_value('scheduler/rejected/redis', spider=self.spider)
+            logger.warning("Scheduler not find callback: %s|%s", obj.get('url'), header.callback,
+                           extra={'spider': self.spider})
+            return False
+        return True
+
+    def _reap_leases(self):
+        if self.io is None:
+            d = defer.maybeDeferred(self.queue.requeue_expired)
+        else:
+            d = self.io.write(self.queue.requeue_expired)
+        d.addCallbacks(self._leases_reaped, self._reap_failed)
+
+    def _leases_reaped(self, count):
+        if count:
+            logger.warning("Scheduler requeued %d expired leases", count, extra={'spider': self.spider})
+
+    def _reap_failed(self, failure):
+        logger.error("Scheduler requeue expired leases failed: %s", failure.getErrorMessage(),
+                     extra={'spider': self.spider})
+
+    def _promote_delayed(self):
+        if self.io is None:
+            d = defer.maybeDeferred(self.delay_queue.promote, self.promote_batch)
+        else:
+            d = self.io.write(self.delay_queue.promote, self.promote_batch)
+        d.addCallbacks(self._delayed_promoted, self._promote_failed)
+
+    def _delayed_promoted(self, count):
+        if count:
+            logger.debug("Scheduler promoted %d delayed retries", count, extra={'spider': self.spider})
+
+    def _promote_failed(self, failure):
+        logger.error("Scheduler promote delayed retries failed: %s", failure.getErrorMessage(),
+                     extra={'spider': self.spider})
+
+    def _fill_prefetch(self):
+        """Refill the prefetch buffer with one batched pop."""
+        count = self.prefetch_size - len(self.prefetched)
+        if count > 0:
+            self.prefetched.extend(self.queue.pop_many(count))
+
+    def _fetch(self):
+        """Batch pop, falling back to a blocking pop. Runs in the io thread."""
+        idle = self.idle
+        if idle is not None:
+            # 空闲时在io线程中等待下一次轮询或唤醒
+            idle.wait()
+            if self._closing:
+                return []
+            idle.begin_poll()
+        requests = self.queue.pop_many(max(self.prefetch_size - len(self.prefetched), 1))
+        if idle is not None:
+            if requests:
+                idle.reset()
+            else:
+                idle.backoff()
+        elif not requests:
+            request = self.queue.pop(self.idle_before_close)
+            if request is not None:
+                requests = [request]
+        return requests
+
+    def _schedule_fetch(self):
+        if self._fetching is not None or self._closing:
+            return
+        d = self.io.read(self._fetch)
+        d.addCallbacks(self._fetched, self._fetch_failed)
+        d.addBoth(self._fetch_finished)
+        self._fetching = d
+
+    def _fetched(self, requests):
+        self.prefetched.extend(requests)
+        if requests:
+            self._wake_engine()
+        return True
+
+    def _fetch_failed(self, failure):
+        logger.error("Scheduler fetch from redis failed: %s", failure.getErrorMessage(),
+                     extra={'spider': self.spider})
+        return False
+
+    def _fetch_finished(self, ok):
+        self._fetching = None
+        # 队列为空时在io线程中继续阻塞等待，不占用reactor；出错时等下一次引擎调用再取
+        if ok and not self._closing and len(self.prefetched) <= self.prefetch_low_water:
+            self._schedule_fetch()
+
+    def _wake_engine(self):
+        """Ask the engine to call ``next_request`` again now that requests arrived."""
+        engine = getattr(getattr(self.spider, 'crawler', None), 'engine', None)
+        slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
     def next_request(self):
         block_pop_timeout = self.idle_before_close
-        request = self.queue.pop(block_pop_timeout)
+        if self.io is not None:
+            if len(self.prefetched) <= self.prefetch_low_water:
+                self._schedule_fetch()
+            request = self.prefetched.popleft() if self.prefetched else None
+        else:
+            idle = self.idle
+            if idle is not None and not self.prefetched and not idle.ready():
+                # 空闲退避中，不访问redis
+                return None
+            if idle is not None:
+                idle.begin_poll()
+                block_pop_timeout = 0
+            if len(self.prefetched) <= self.prefetch_low_water:
+                self._fill_prefetch()
+            if self.prefetched:
+                request = self.prefetched.popleft()
+            else:
+                request = self.queue.pop(block_pop_timeout)
+            if idle is not None:
+                if request is None:
+                    idle.backoff()
+                else:
+                    idle.reset()
         if request and self.stats:
             request = self.spider.check_request_callback(request)
             if request is not None:
@@ -1,14 +1,26 @@
-from . import picklecompat
+import logging
+from collections import OrderedDict
+
+from twisted.internet import task
+from twisted.python.failure import Failure
+
+from . import defaults, picklecompat, request_task
 from .task_defined import TASK_QUEUE_KEY
 from scrapy.utils.reqser import request_to_dict, request_from_dict
+from .fingerprint import Fingerprinter
+
+
+logger = logging.getLogger(__name__)
 
 
 class processed_task_queue(object):
 
-    def __init__(self, server, spider):
+    def __init__(self, server, spider, io=None, serializer=None):
         self.server = server
         self.spider = spider
-        self.serializer = picklecompat
+        # threadio.RedisIO，不为空时在独立线程中写redis
+        self.io = io
+        self.serializer = serializer or picklecompat
         self.key = TASK_QUEUE_KEY['processed_queue']
 
     def _encode_request(self, request):
@@ -23,7 +35,21 @@ class processed_task_queue(object):
 
     def push(self, request):
         r = self.server
-        r.lpush(self.key, self._encode_request(request))
+        data = self._encode_request(request)
+        if self.io is None:
+            r.lpush(self.key, data)
+        else:
+            d = self.io.write(r.lpush, self.key, data)
+            d.addErrback(self._push_failed, request)
+
+    def push_dict(self, obj):
+        """Push an already decoded request dict. Always writes synchronously,
+        so it is safe to call from the redis io thread."""
+        self.server.lpush(self.key, self.serializer.dumps(obj))
+
+    def _push_failed(self, failure, request):
+        logger.error("processed_task_queue push failed: %s|%s", request.url, failure.getErrorMessage(),
+                     extra={'spider': self.spider})
 
     def clear(self):
         r = self.server
@@ -34,5 +60,130 @@ class processed_task_queue(object):
         return r.llen(self.key)
 
 
+class buffered_task_queue(processed_task_queue):
+    """processed_task_queue that coalesces pushes.
+
+    Encoded requests are buffered and written with a single LPUSH when
+    ``flush_size`` records or ``max_bytes`` bytes are buffered, every
+    ``flush_interval`` seconds and on ``close``. Lease tokens given to ``ack``
+    are released in the same pipeline, after the state they belong to is
+    written. If a flush fails the records are kept for the next one, but the
+    buffer never holds more than ``max_bytes``; older records are dropped.
+
+    With ``state_events`` enabled, ``push_state`` reports completed and failed
+    requests as ``RequestTask.state_event`` records on ``state_queue``, and
+    only requests which need dispatching again go to ``processed_queue``.
+    """
+
+    def __init__(self, server, spider, io=None, serializer=None, lease_queue=None,
+                 flush_size=defaults.SCHEDULER_STATE_FLUSH_SIZE,
+                 flush_interval=defaults.SCHEDULER_STATE_FLUSH_INTERVAL,
+                 max_bytes=defaults.SCHEDULER_STATE_BUFFER_MAX_BYTES,
+                 state_events=defaults.SCHEDULER_STATE_EVENTS, fingerprinter=None):
+        super(buffered_task_queue, self).__init__(server, spider, io=io, serializer=serializer)
+        # 与dupefilter共用，指纹只计算一次
+        self.fingerprinter = fingerprinter or Fingerprinter()
+        self.state_events = state_events
+        self.state_key = TASK_QUEUE_KEY['state_queue']
+        # SpiderPriorityQueue，用于释放可靠队列的租约
+        self.lease_queue = lease_queue
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        # (key, data)
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.tokens = []
+        self._flusher = None
+
+    @classmethod
+    def from_spider(cls, server, spider, **kwargs):
+        settings = spider.settings
+        return cls(server, spider,
+                   flush_size=settings.getint('SCHEDULER_STATE_FLUSH_SIZE', defaults.SCHEDULER_STATE_FLUSH_SIZE),
+                   flush_interval=settings.getfloat('SCHEDULER_STATE_FLUSH_INTERVAL',
+                                                    defaults.SCHEDULER_STATE_FLUSH_INTERVAL),
+                   max_bytes=settings.getint('SCHEDULER_STATE_BUFFER_MAX_BYTES',
+                                             defaults.SCHEDULER_STATE_BUFFER_MAX_BYTES),
+                   state_events=settings.getbool('SCHEDULER_STATE_EVENTS', defaults.SCHEDULER_STATE_EVENTS),
+                   **kwargs)
+
+    def open(self):
+        if self.flush_interval > 0 and self._flusher is None:
+            self._flusher = task.LoopingCall(self.flush)
+            self._flusher.start(self.flush_interval, now=False)
+
+    def close(self):
+        if self._flusher is not None and self._flusher.running:
+            self._flusher.stop()
+        self._flusher = None
+        return self.flush()
+
+    def push(self, request):
+        self._buffer(self.key, self._encode_request(request))
+
+    def push_state(self, request, request_state):
+        """Report a completed or failed request."""
+        if not self.state_events:
+            request_task.RequestTask.from_request(request).request_state = request_state
+            self.push(request)
+            return
+        task = request_task.RequestTask.from_request(request)
+        event = task.state_event(self.fingerprinter(request), request_state)
+        self._buffer(self.state_key, self.serializer.dumps(event))
+
+    def _buffer(self, key, data):
+        self.buffer.append((key, data))
+        self.buffer_bytes += len(data)
+        if len(self.buffer) >= self.flush_size or self.buffer_bytes >= self.max_bytes:
+            self.flush()
+
+    def ack(self, token):
+        """Release a lease with the next flush."""
+        self.tokens.append(token)
+        if len(self.tokens) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        datas, tokens = self.buffer, self.tokens
+        if not datas and not tokens:
+            return
+        self.buffer, self.tokens, self.buffer_bytes = [], [], 0
+        if self.io is None:
+            try:
+                self._write(datas, tokens)
+            except Exception:
+                self._flush_failed(Failure(), datas, tokens)
+        else:
+            d = self.io.write(self._write, datas, tokens)
+            d.addErrback(self._flush_failed, datas, tokens)
+            return d
+
+    def _write(self, datas, tokens):
+        groups = OrderedDict()
+        for key, data in datas:
+            groups.setdefault(key, []).append(data)
+        pipe = self.server.pipeline()
+        for key, values in groups.items():
+            pipe.lpush(key, *values)
+        if tokens and self.lease_queue is not None:
+            self.lease_queue.ack_tokens(tokens, pipe=pipe)
+        pipe.execute()
+
+    def _flush_failed(self, failure, datas, tokens):
+        logger.error("buffered_task_queue flush of %d records failed: %s", len(datas), failure.getErrorMessage(),
+                     extra={'spider': self.spider})
+        self.buffer[:0] = datas
+        self.tokens[:0] = tokens
+        self.buffer_bytes += sum(len(data) for _, data in datas)
+        dropped = 0
+        while self.buffer and self.buffer_bytes > self.max_bytes:
+            self.buffer_bytes -= len(self.buffer.pop(0)[1])
+            dropped += 1
+        if dropped:
+            logger.error("buffered_task_queue over %d bytes, dropped %d records", self.max_bytes, dropped,
+                         extra={'spider': self.spider})
+
+
 
 
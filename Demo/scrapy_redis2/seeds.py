@@ -0,0 +1,181 @@
+"""Bulk seed loading for a task.
+
+Reads a file of seeds, one per line, either a plain url or a JSON object::
+
+    {"url": "http://example.com/", "task_no": "1", "priority": 2, "params": {...},
+     "method": "GET", "headers": {...}, "body": "..."}
+
+Seeds are built with ``RequestTask.from_create``, deduped in batches against
+the task's bloom filter (the one ``RFPDupeFilter`` uses) and marked
+``dont_filter``, encoded like the scheduler does and pushed with one pipelined LPUSH per list and batch, either
+onto the priority lists or onto ``TASK_QUEUE_KEY['start_url']``. Only one
+batch is held in memory at a time.
+
+Usage::
+
+    python -m scrapy_redis2.seeds seeds.jsonl --task-id 42 --task-type list
+"""
+import argparse
+import json
+import logging
+import sys
+
+from scrapy.http import Request
+from scrapy.utils.project import get_project_settings
+
+from . import connection
+from .dupefilter import RFPDupeFilter
+from .queue import SpiderPriorityQueue
+from .request_task import RequestTask
+from .task_defined import TASK_QUEUE_KEY
+from .utils import get_queue_class_from_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_seeds(lines):
+    """Yields a dict with at least ``url`` for each non-empty line."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                seed = json.loads(line)
+            except ValueError:
+                logger.warning("Invalid seed line: %s", line)
+                continue
+            if not isinstance(seed, dict) or not seed.get('url'):
+                logger.warning("Seed without url: %s", line)
+                continue
+            yield seed
+        else:
+            yield {'url': line}
+
+
+class SeedLoader(object):
+    """Push seeds of one task onto the scheduler queues in batches."""
+
+    def __init__(self, server, task_id, task_type=None, priority=4, depth=None, ttl=None, queue=None,
+                 dupefilter=None, batch_size=1000, start_url=False):
+        """
+        Parameters
+        ----------
+        server : redis.StrictRedis
+        task_id : str
+            Task the seeds belong to, also selects the bloom filter.
+        task_type, priority, depth, ttl
+            Defaults for ``RequestTask.from_create``, seeds may override
+            ``priority``.
+        queue : SpiderPriorityQueue
+            Encodes requests and selects their priority list.
+        dupefilter : RFPDupeFilter, optional
+            Seeds it has already seen are skipped. None disables deduping.
+        batch_size : int
+            Seeds deduped and pushed per round trip.
+        start_url : bool
+            Push onto ``TASK_QUEUE_KEY['start_url']`` instead of the priority lists.
+        """
+        self.server = server
+        self.task_id = task_id
+        self.task_type = task_type
+        self.priority = priority
+        self.depth = depth
+        self.ttl = ttl
+        self.queue = queue if queue is not None else SpiderPriorityQueue(server, None)
+        self.dupefilter = dupefilter
+        self.batch_size = batch_size
+        self.start_url = start_url
+        self.stats = {'read': 0, 'invalid': 0, 'duplicate': 0, 'pushed': 0}
+
+    @classmethod
+    def from_settings(cls, settings, task_id, dedupe=True, spider_name=None, **kwargs):
+        server = connection.from_settings(settings)
+        queue_cls = get_queue_class_from_settings(settings)
+        queue = queue_cls.from_settings(server, settings, spider_name=spider_name)
+        dupefilter = None
+        if dedupe:
+            # 种子一般不会重复出现，不需要本地缓存
+            kwargs_df = RFPDupeFilter._settings_kwargs(settings)
+            kwargs_df['cache_max_bytes'] = 0
+            dupefilter = RFPDupeFilter(server=server, **kwargs_df)
+        return cls(server, task_id, queue=queue, dupefilter=dupefilter, **kwargs)
+
+    def make_request(self, seed):
+        task = RequestTask.from_create(self.task_id, task_no=seed.get('task_no'),
+                                       priority=seed.get('priority', self.priority), depth=self.depth,
+                                       task_type=seed.get('task_type', self.task_type), params=seed.get('params'),
+                                       ttl=self.ttl)
+        return Request(seed['url'], method=seed.get('method', 'GET'), headers=seed.get('headers'),
+                       body=seed.get('body'), meta={'crawler_scheduler': task.crawler_scheduler})
+
+    def load(self, seeds):
+        """Push all ``seeds`` (dicts as yielded by ``iter_seeds``), returns the stats."""
+        batch = []
+        for seed in seeds:
+            self.stats['read'] += 1
+            try:
+                batch.append(self.make_request(seed))
+            except (TypeError, ValueError) as e:
+                self.stats['invalid'] += 1
+                logger.warning("Invalid seed %s: %s", seed.get('url'), e)
+                continue
+            if len(batch) >= self.batch_size:
+                self.push_batch(batch)
+                batch = []
+        if batch:
+            self.push_batch(batch)
+        return self.stats
+
+    def push_batch(self, requests):
+        if self.dupefilter is not None:
+            seen = self.dupefilter.requests_seen(requests)
+            self.stats['duplicate'] += sum(seen)
+            requests = [request for request, val in zip(requests, seen) if not val]
+            # 已加入过滤器，弹出后经engine.crawl进入调度器时不能再被当作重复
+            for request in requests:
+                request.dont_filter = True
+        if not requests:
+            return
+        groups = self.queue.encode_many(requests)
+        if self.start_url:
+            # start_url是普通list，与队列类型(分组key可能是元组)无关
+            self.server.lpush(TASK_QUEUE_KEY['start_url'], *[data for datas in groups.values() for data in datas])
+        else:
+            self.queue.push_encoded(groups)
+        self.stats['pushed'] += len(requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load seeds of a task into the scheduler queues.")
+    parser.add_argument('path', help="File with one url or JSON object per line, '-' for stdin.")
+    parser.add_argument('--task-id', required=True)
+    parser.add_argument('--task-type')
+    parser.add_argument('--priority', type=int, default=4)
+    parser.add_argument('--depth', type=int)
+    parser.add_argument('--ttl', type=int)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--start-url', action='store_true', help="Push onto the start_url list.")
+    parser.add_argument('--no-dedupe', action='store_true', help="Do not check the task's bloom filter.")
+    parser.add_argument('--spider', help="Spider name, the queue namespace with SCHEDULER_QUEUE_ROUTING=spider.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    loader = SeedLoader.from_settings(get_project_settings(), args.task_id, dedupe=not args.no_dedupe,
+                                      spider_name=args.spider,
+                                      task_type=args.task_type, priority=args.priority, depth=args.depth,
+                                      ttl=args.ttl, batch_size=args.batch_size, start_url=args.start_url)
+    if args.path == '-':
+        stats = loader.load(iter_seeds(sys.stdin))
+    else:
+        with open(args.path, 'rb') as f:
+            stats = loader.load(iter_seeds(f))
+    logger.info("Seeds loaded: %s", stats)
+    return stats
+
+
+if __name__ == '__main__':
+    main()
@@ -2,31 +2,50 @@ from scrapy import signals
 from scrapy.exceptions import DontCloseSpider
 from scrapy.spiders import Spider, CrawlSpider
 from scrapy.http import Request, Response
-from scrapy.spidermiddlewares import httperror
+from scrapy.spidermiddlewares.httperror import HttpError
 from twisted.internet.error import DNSLookupError, TCPTimedOutError
 from twisted.python.failure import Failure
 import scrapy
 import time
 import copy
 
-from . import connection, defaults, request_task
-from .queue import SpiderPriorityQueue
-from .schedulertask import processed_task_queue
+from . import connection, defaults, request_task, threadio
+from .dupefilter import RFPDupeFilter
+from .queue import LEASE_META_KEY
+from .schedulertask import buffered_task_queue
+from .utils import get_queue_class_from_settings, get_serializer_from_settings
 
 
 class RedisMixin(object):
     """Mixin class to implement reading urls from a redis queue."""
     redis_encoding = None
+    redis_batch_size = None
+    dupefilter_batch_size = None
 
     # Redis client placeholder.
     server = None
+    # threadio.RedisIO placeholder, set when SCHEDULER_ASYNC_IO is enabled.
+    redis_io = None
+    # SpiderPriorityQueue placeholder.
+    task_queue = None
+    # Request serializer placeholder.
+    serializer = None
+    # buffered_task_queue placeholder, reports request states to processed_queue.
+    state_writer = None
+    # RFPDupeFilter placeholder, checks the requests returned by callbacks in batches.
+    dupefilter = None
 
     callbacks = None
 
     def start_requests(self):
         """Returns a batch of start requests from redis."""
-        req = self.next_requests()
-        if req is not None:
+        reqs = self.next_requests_batch()
+        # 异步模式下不在reactor线程阻塞等待，由调度器在io线程中取
+        if not reqs and self.redis_io is None:
+            req = self.next_requests()
+            if req is not None:
+                reqs = [req]
+        for req in reqs:
             yield req
 
     def setup_redis(self, crawler=None):
@@ -53,15 +72,32 @@ class RedisMixin(object):
         if self.redis_encoding is None:
             self.redis_encoding = settings.get('REDIS_ENCODING', defaults.REDIS_ENCODING)
 
+        if self.redis_batch_size is None:
+            self.redis_batch_size = settings.getint('REDIS_START_URLS_BATCH_SIZE',
+                                                    settings.getint('CONCURRENT_REQUESTS'))
+
+        if self.dupefilter_batch_size is None:
+            self.dupefilter_batch_size = settings.getint('DUPEFILTER_BATCH_SIZE', defaults.DUPEFILTER_BATCH_SIZE)
+
         self.server = connection.from_settings(crawler.settings)
+        if settings.getbool('SCHEDULER_ASYNC_IO', defaults.SCHEDULER_ASYNC_IO):
+            self.redis_io = threadio.get_redis_io()
+        self.serializer = get_serializer_from_settings(settings)
+        self.task_queue = get_queue_class_from_settings(settings).from_spider(self.server, self,
+                                                                              serializer=self.serializer)
+        self.dupefilter = RFPDupeFilter.from_spider(self.server, self)
+        self.state_writer = buffered_task_queue.from_spider(self.server, self, io=self.redis_io,
+                                                            serializer=self.serializer, lease_queue=self.task_queue,
+                                                            fingerprinter=self.dupefilter.fingerprinter)
+        crawler.signals.connect(self.state_writer.open, signal=signals.spider_opened)
+        crawler.signals.connect(self.state_writer.close, signal=signals.spider_closed)
         # The idle signal is called when the spider has no requests left,
         # that's when we will schedule new requests from redis queue
         crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
 
     def next_requests(self):
         """Returns a request to be scheduled or none."""
-        task_queue = SpiderPriorityQueue(self.server, self)
-        request = task_queue.pop(defaults.SCHEDULER_IDLE_BEFORE_CLOSE)
+        request = self.task_queue.pop(defaults.SCHEDULER_IDLE_BEFORE_CLOSE)
         if request is not None:
             #request = self.check_request_callback(request)
             if request is not None:
@@ -70,11 +106,25 @@ class RedisMixin(object):
                 return request
         return None
 
+    def next_requests_batch(self):
+        """Returns up to ``redis_batch_size`` requests popped in one round trip."""
+        reqs = self.task_queue.pop_many(self.redis_batch_size)
+        for request in reqs:
+            self.logger.info("RedisMixin.next_requests_batch --> SpiderPriorityQueue:%s|callback:%s|errback:%s|meta:%s",
+                             request.url, str(request.callback), str(request.errback), str(request.meta))
+        return reqs
+
     def schedule_next_requests(self):
-        """Schedules a request if available"""
-        # TODO: While there is capacity, schedule a batch of redis requests.
-        req = self.next_requests()
-        if req is not None:
+        """Schedules a batch of requests if available"""
+        if self.redis_io is not None:
+            d = self.redis_io.read(self.next_requests_batch)
+            d.addCallback(self._crawl_requests)
+            d.addErrback(lambda f: self.logger.error("RedisMixin.schedule_next_requests: " + f.getErrorMessage()))
+            return d
+        self._crawl_requests(self.next_requests_batch())
+
+    def _crawl_requests(self, reqs):
+        for req in reqs:
             self.crawler.engine.crawl(req, spider=self)
 
     def spider_idle(self):
@@ -93,7 +143,8 @@ class RedisMixin(object):
     def make_request_from_responses(self, response, url, task_type=None, callback=None, method='GET', headers=None,
                                     body=None, cookies=None, meta=None, encoding='utf-8', priority=0,
                                     errback=None, flags=None, formdata=None,
-                                    request_state=request_task.TASK_REQUEST_STATE_CODE_PROCESSED):
+                                    request_state=request_task.TASK_REQUEST_STATE_CODE_PROCESSED,
+                                    dont_filter=False):
 
         if not isinstance(response, Response):
             raise ValueError("make_request_from_responses: response is required")
@@ -121,11 +172,11 @@ class RedisMixin(object):
         task.enqueue_time = None
         if formdata is not None:
             return scrapy.FormRequest(url=url, formdata=formdata, meta=meta, callback=None, method=method,
-                                      headers=headers, cookies=cookies, dont_filter=True, errback=None,
+                                      headers=headers, cookies=cookies, dont_filter=dont_filter, errback=None,
                                       encoding=encoding, priority=priority, flags=flags, body=body)
         else:
             return Request(url, meta=meta, callback=None, method=method, headers=headers, cookies=cookies,
-                           dont_filter=True, errback=None, encoding=encoding, priority=priority,
+                           dont_filter=dont_filter, errback=None, encoding=encoding, priority=priority,
                            flags=flags, body=body)
 
     def update_request_state(self, response):
@@ -135,7 +186,7 @@ class RedisMixin(object):
             self.logger.info('RedisMixin.update_request_state -->completed: ' + str(response))
         elif isinstance(response, Failure):
             request_state = request_task.TASK_REQUEST_STATE_CODE_ERROR
-            if response.check(httperror):
+            if response.check(HttpError):
                 self.logger.error('RedisMixin.update_request_state -->error: ' + repr(response))
                 request = response.value.response.request
             elif response.check(DNSLookupError):
@@ -145,15 +196,29 @@ class RedisMixin(object):
                 self.logger.error('RedisMixin.update_request_state -->error: ' + repr(response))
                 request = response.request
             else:
+                # 其他失败(IgnoreRequest、连接被拒等)同样上报错误并释放租约，否则租约到期后会被反复重新下发
                 self.logger.error('RedisMixin.update_request_state1 -->unknown: ' + repr(response))
-                return
+                request = getattr(response, 'request', None)
+                if request is None:
+                    return
         else:
             self.logger.error('RedisMixin.update_request_state2 -->unknown: ' + repr(response))
             return
-        task = request_task.RequestTask.from_request(request)
-        task.request_state = request_state
-        processed_queue = processed_task_queue(self.server, self)
-        processed_queue.push(request)
+        self.state_writer.push_state(request, request_state)
+        self.ack_request(request)
+
+    def ack_request(self, request):
+        """Releases the reliable queue lease held for ``request``, if any.
+
+        The lease is released with the next state flush, after the states
+        pushed before it are written.
+        """
+        self.ack_lease(request.meta.pop(LEASE_META_KEY, None))
+
+    def ack_lease(self, token):
+        """Releases a reliable queue lease by token, see ``ack_request``."""
+        if token is not None and self.task_queue.reliable:
+            self.state_writer.ack(token)
 
     def pre_parse(self, response):
         self.logger.info("RedisMixin.pre_parse --> response: %s", response.url)
@@ -161,15 +226,52 @@ class RedisMixin(object):
         callback = self.parse
         if task.callback is not None:
             callback = self._get_callback(task.callback)
-        reqs = callback(response)
-        if reqs is not None:
-            yield from reqs
-        self.update_request_state(response)
+        completed = False
+        try:
+            reqs = callback(response)
+            if reqs is not None:
+                yield from self.filter_requests(reqs)
+            completed = True
+        finally:
+            if completed:
+                self.update_request_state(response)
+            else:
+                # 回调或去重出错(或输出未取完)时上报错误并释放租约，否则租约到期后会被反复重新下发
+                self.logger.error('RedisMixin.pre_parse -->error: ' + response.url)
+                self.state_writer.push_state(response.request, request_task.TASK_REQUEST_STATE_CODE_ERROR)
+                self.ack_request(response.request)
+
+    def filter_requests(self, results):
+        """Drops already seen requests from a callback's output.
+
+        Requests are checked against the dupefilter ``dupefilter_batch_size``
+        at a time, one redis round trip per batch. The ones kept are marked
+        ``dont_filter`` so the scheduler does not check them again.
+        """
+        batch = []
+        for obj in results:
+            if isinstance(obj, Request) and not obj.dont_filter and self.dupefilter is not None:
+                batch.append(obj)
+                if len(batch) >= self.dupefilter_batch_size:
+                    yield from self._filter_batch(batch)
+                    batch = []
+            else:
+                yield obj
+        if batch:
+            yield from self._filter_batch(batch)
+
+    def _filter_batch(self, batch):
+        for request, seen in zip(batch, self.dupefilter.requests_seen(batch)):
+            if seen:
+                self.dupefilter.log(request, self)
+                continue
+            request.dont_filter = True
+            yield request
 
     def pre_parse_errback(self, failure):
         self.logger.info("RedisMixin.pre_parse --> response: %s", str(failure))
         errback = None
-        if failure.check(httperror):
+        if failure.check(HttpError):
             request = failure.value.response.request
             errback = self._get_callback(request_task.RequestTask.get_errback_from_request(request))
         elif failure.check(DNSLookupError):
@@ -180,13 +282,16 @@ class RedisMixin(object):
             errback = self._get_callback(request_task.RequestTask.get_errback_from_request(request))
         else:
             self.logger.warning('RedisMixin.pre_parse_errback -->unknown: ' + repr(failure))
-        if errback is not None:
-            errback(failure)
-        self.update_request_state(failure)
+        try:
+            if errback is not None:
+                errback(failure)
+        finally:
+            # 任何失败都上报状态并释放租约
+            self.update_request_state(failure)
 
     def check_request_callback(self, request):
         task = request_task.RequestTask.from_request(request)
-        processed_queue = processed_task_queue(self.server, self)
+        processed_queue = self.state_writer
         if task.callback is not None:
             callback = self._get_callback(task.callback)
             if callback is None:
@@ -194,6 +299,7 @@ class RedisMixin(object):
                                     str(request.meta['crawler_scheduler']))
                 task.request_state = request_task.TASK_REQUEST_STATE_CODE_RETRIED
                 processed_queue.push(request)
+                self.ack_request(request)
                 return None
         if task.errback is not None:
             errback = self._get_callback(task.errback)
@@ -202,6 +308,7 @@ class RedisMixin(object):
                                     str(request.meta['crawler_scheduler']))
                 task.request_state = request_task.TASK_REQUEST_STATE_CODE_RETRIED
                 processed_queue.push(request)
+                self.ack_request(request)
                 return None
         request.callback = self.pre_parse
         request.errback = self.pre_parse_errback
@@ -250,6 +357,9 @@ class RedisSpider(RedisMixin, Spider):
         Redis key where to fetch start URLs from..
     redis_batch_size : int (default: CONCURRENT_REQUESTS)
         Number of messages to fetch from redis on each attempt.
+    dupefilter_batch_size : int (default: DUPEFILTER_BATCH_SIZE)
+        Number of requests yielded by a callback checked against the
+        dupefilter in one redis round trip.
     redis_encoding : str (default: REDIS_ENCODING)
         Encoding to use when decoding messages from redis queue.
 
@@ -259,6 +369,8 @@ class RedisSpider(RedisMixin, Spider):
         Default Redis key where to fetch start URLs from..
     REDIS_START_URLS_BATCH_SIZE : int (deprecated by CONCURRENT_REQUESTS)
         Default number of messages to fetch from redis on each attempt.
+    DUPEFILTER_BATCH_SIZE : int (default: 500)
+        Default ``dupefilter_batch_size``.
     REDIS_START_URLS_AS_SET : bool (default: False)
         Use SET operations to retrieve messages from the redis queue. If False,
         the messages are retrieve using the LPOP command.
@@ -283,6 +395,9 @@ class RedisCrawlSpider(RedisMixin, CrawlSpider):
         Redis key where to fetch start URLs from..
     redis_batch_size : int (default: CONCURRENT_REQUESTS)
         Number of messages to fetch from redis on each attempt.
+    dupefilter_batch_size : int (default: DUPEFILTER_BATCH_SIZE)
+        Number of requests yielded by a callback checked against the
+        dupefilter in one redis round trip.
     redis_encoding : str (default: REDIS_ENCODING)
         Encoding to use when decoding messages from redis queue.
 
@@ -292,6 +407,8 @@ class RedisCrawlSpider(RedisMixin, CrawlSpider):
         Default Redis key where to fetch start URLs from..
     REDIS_START_URLS_BATCH_SIZE : int (deprecated by CONCURRENT_REQUESTS)
         Default number of messages to fetch from redis on each attempt.
+    DUPEFILTER_BATCH_SIZE : int (default: 500)
+        Default ``dupefilter_batch_size``.
     REDIS_START_URLS_AS_SET : bool (default: True)
         Use SET operations to retrieve messages from the redis queue.
     REDIS_ENCODING : str (default: "utf-8")
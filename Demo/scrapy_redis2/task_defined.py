@@ -7,7 +7,26 @@ TASK_QUEUE_KEY = {
         'sunlife_scheduler:priority_queue_3',
         'sunlife_scheduler:priority_queue_4',
     ],
-    'processed_queue': 'sunlife_scheduler:processed_queue'
+    'processed_queue': 'sunlife_scheduler:processed_queue',
+    # 请求完成/失败的状态事件(RequestTask.state_event)，SCHEDULER_STATE_EVENTS 开启时使用
+    'state_queue': 'sunlife_scheduler:state_queue',
+    # 可靠队列: 每个worker的租约(zset: token -> 到期时间)及数据(hash: token -> request, token:q -> 来源队列)
+    'inflight_queue': 'sunlife_scheduler:inflight:%s',
+    'inflight_data': 'sunlife_scheduler:inflight_data:%s',
+    'inflight_workers': 'sunlife_scheduler:inflight_workers',
+    'lease_seq': 'sunlife_scheduler:lease_seq',
+    # 公平模式: task_id -> 每轮连续出队的请求数(默认1)
+    'task_weights': 'sunlife_scheduler:task_weights',
+    # SortedPriorityQueue 使用的有序集合及入队序号
+    'sorted_queue': 'sunlife_scheduler:sorted_queue',
+    'sorted_seq': 'sunlife_scheduler:sorted_seq',
+    'sorted_head_seq': 'sunlife_scheduler:sorted_head_seq',
+    # 延迟重试: zset token -> 到期时间，hash 中按租约的格式保存数据及目标队列
+    'delay_queue': 'sunlife_scheduler:delay_queue',
+    'delay_data': 'sunlife_scheduler:delay_data',
+    'delay_seq': 'sunlife_scheduler:delay_seq',
+    # 入队时发布，唤醒空闲退避中的worker
+    'wakeup_channel': 'sunlife_scheduler:wakeup',
 }
 
 # TASK_QUEUE_KEY = {
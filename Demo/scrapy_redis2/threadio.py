@@ -0,0 +1,60 @@
+"""Run blocking redis calls outside of the Twisted reactor thread."""
+import threading
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+
+class RedisIO(object):
+    """Dedicated redis I/O threads returning Deferreds.
+
+    Reads (possibly blocking pops) and writes run on two separate single
+    threaded pools, so a ``BRPOP`` waiting for work never delays pushes, and
+    pushes keep the order they were issued in.
+    """
+
+    def __init__(self, name='scrapy_redis2'):
+        self._reader = ThreadPool(minthreads=1, maxthreads=1, name=name + '-reader')
+        self._writer = ThreadPool(minthreads=1, maxthreads=1, name=name + '-writer')
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._reader.start()
+            self._writer.start()
+            self._started = True
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        self._reader.stop()
+        self._writer.stop()
+
+    def read(self, func, *args, **kwargs):
+        """Call ``func`` in the reader thread, returns a Deferred."""
+        self.start()
+        return threads.deferToThreadPool(reactor, self._reader, func, *args, **kwargs)
+
+    def write(self, func, *args, **kwargs):
+        """Call ``func`` in the writer thread, returns a Deferred."""
+        self.start()
+        return threads.deferToThreadPool(reactor, self._writer, func, *args, **kwargs)
+
+
+_redis_io = None
+_redis_io_lock = threading.Lock()
+
+
+def get_redis_io():
+    """Returns the process-wide ``RedisIO`` shared by scheduler and spider."""
+    global _redis_io
+    with _redis_io_lock:
+        if _redis_io is None:
+            _redis_io = RedisIO()
+    return _redis_io
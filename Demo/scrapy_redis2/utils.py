@@ -1,4 +1,9 @@
+import importlib
+
 import six
+from scrapy.utils.misc import load_object
+
+from . import defaults, picklecompat
 
 
 def bytes_to_str(s, encoding='utf-8'):
@@ -6,3 +11,27 @@ def bytes_to_str(s, encoding='utf-8'):
     if six.PY3 and isinstance(s, bytes):
         return s.decode(encoding)
     return s
+
+
+def get_serializer_from_settings(settings):
+    """Returns the serializer selected by ``SCHEDULER_SERIALIZER``.
+
+    The setting may be a module or a path to one, exposing ``loads`` and
+    ``dumps``. If it also has ``from_settings``, that is used to build a
+    configured serializer. Defaults to ``picklecompat``.
+    """
+    serializer = settings.get('SCHEDULER_SERIALIZER') or picklecompat
+    # Support serializer as a path to a module.
+    if isinstance(serializer, six.string_types):
+        serializer = importlib.import_module(serializer)
+    if hasattr(serializer, 'from_settings'):
+        serializer = serializer.from_settings(settings)
+    return serializer
+
+
+def get_queue_class_from_settings(settings):
+    """Returns the queue class selected by ``SCHEDULER_QUEUE_CLASS``."""
+    queue_cls = settings.get('SCHEDULER_QUEUE_CLASS') or defaults.SCHEDULER_QUEUE_CLASS
+    if isinstance(queue_cls, six.string_types):
+        queue_cls = load_object(queue_cls)
+    return queue_cls
@@ -0,0 +1,113 @@
+"""Idle backoff for workers finding the queues empty.
+
+A worker that finds no work polls again after ``min_delay`` seconds, then
+after twice as long and so on up to ``max_delay``. Whoever pushes requests
+publishes on ``TASK_QUEUE_KEY['wakeup_channel']``; a listener thread
+subscribed to it ends the wait at once, so idle workers cost almost no
+redis traffic without adding latency to new work. Without a working
+subscription workers still poll every ``max_delay`` seconds.
+"""
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from . import defaults
+from .task_defined import TASK_QUEUE_KEY
+
+
+logger = logging.getLogger(__name__)
+
+
+def publish_wakeup(client, channel=TASK_QUEUE_KEY['wakeup_channel']):
+    """Wake up idle workers, ``client`` may be a pipeline."""
+    return client.publish(channel, 1)
+
+
+class IdleBackoff(object):
+    """Exponential backoff between polls of empty queues, cut short by wakeups"""
+
+    def __init__(self, server, channel=TASK_QUEUE_KEY['wakeup_channel'], min_delay=defaults.SCHEDULER_IDLE_MIN_DELAY,
+                 max_delay=defaults.SCHEDULER_IDLE_MAX_DELAY, factor=2):
+        self.server = server
+        self.channel = channel
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self.factor = factor
+        # 0 表示不在空闲状态
+        self.delay = 0
+        self._next_poll = 0
+        self._event = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls, server, settings):
+        """Returns an ``IdleBackoff``, None if ``SCHEDULER_IDLE_BACKOFF`` is off."""
+        if not settings.getbool('SCHEDULER_IDLE_BACKOFF', defaults.SCHEDULER_IDLE_BACKOFF):
+            return None
+        return cls(server,
+                   min_delay=settings.getfloat('SCHEDULER_IDLE_MIN_DELAY', defaults.SCHEDULER_IDLE_MIN_DELAY),
+                   max_delay=settings.getfloat('SCHEDULER_IDLE_MAX_DELAY', defaults.SCHEDULER_IDLE_MAX_DELAY))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._listen, name='scrapy_redis2-wakeup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        # 结束正在等待的wait()
+        self._event.set()
+        self._thread = None
+
+    def _listen(self):
+        pubsub = None
+        while not self._stopped.is_set():
+            try:
+                if pubsub is None:
+                    pubsub = self.server.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                if pubsub.get_message(timeout=1.0) is not None:
+                    self._event.set()
+            except RedisError as e:
+                logger.warning("Wakeup subscription to %s failed: %s", self.channel, e)
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except RedisError:
+                        pass
+                pubsub = None
+                self._stopped.wait(self.max_delay)
+        if pubsub is not None:
+            pubsub.close()
+
+    def begin_poll(self):
+        """Call right before polling the queues, wakeups from now on end the next wait"""
+        self._event.clear()
+
+    def backoff(self):
+        """The poll found nothing: wait longer before the next one, returns the delay"""
+        self.delay = min(self.delay * self.factor, self.max_delay) if self.delay else self.min_delay
+        self._next_poll = time.time() + self.delay
+        return self.delay
+
+    def reset(self):
+        """The poll found work"""
+        self.delay = 0
+
+    def ready(self):
+        """Returns True if the queues should be polled now"""
+        return not self.delay or self._event.is_set() or time.time() >= self._next_poll
+
+    def wait(self):
+        """Block until the next poll is due or a wakeup arrives"""
+        if not self.delay:
+            return
+        timeout = self._next_poll - time.time()
+        if timeout > 0:
+            self._event.wait(timeout)